@@ -15,6 +15,7 @@ In command execution mode, supported commands are:
    configure     Configure a cloud
    show          Show cloud configuration
    topology      Display cloud topology
+   stats         Display cache statistics (after building the topology)
    wipe          Wipe the entire cloud
    unconfigure   Unconfigure a cloud
 '''
@@ -66,6 +67,10 @@ By default, MiniCloud runs interactively.
             self.mc().show_cloud()
         elif self.cmd == 'topology':
             self.mc().topologize()
+        elif self.cmd == 'stats':
+            mc = self.mc()
+            mc.topologize()
+            mc.show_stats()
         elif self.cmd == 'wipe':
             self.mc().clear()
         elif self.cmd == 'unconfigure':
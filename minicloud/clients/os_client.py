@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+import threading
 import time
 
 from minicloud.core.core_in import boolean_error, shell_variable
@@ -6,7 +10,8 @@ from minicloud.core.core_out import end, error, error_n, \
 from minicloud.core.core_types import AuthorizationException, \
     HttpAccessException, InUseException, IntegrityException, \
     MiniCloudException
-from minicloud.core.core_utils import _, __
+from minicloud.core.core_utils import _, __, parallel_map, \
+    write_private_file
 
 import requests
 
@@ -14,6 +19,7 @@ __author__ = 'Kris Sterckx'
 
 CLOSE = True
 SLOW_SYSTEM = shell_variable('WINDIR')  # slow on windows
+TOKEN_CACHE = shell_variable('MINICLOUD_TOKEN_CACHE')  # opt-in
 
 # suppress warning
 requests.packages.urllib3.disable_warnings()
@@ -34,6 +40,8 @@ try:
         as KeyStoneConnectionFailure
     from keystoneauth1.exceptions.http import NotFound \
         as KeyStoneHttpNotFound
+    from keystoneauth1.exceptions.http import Unauthorized \
+        as KeyStoneUnauthorized
     from osc_lib.exceptions import \
         Forbidden, AuthorizationFailure, Unauthorized
     from neutronclient.v2_0 import client as neutron_client_v2
@@ -89,6 +97,9 @@ except ImportError as e:
         class KeyStoneHttpNotFound(object):
             pass
 
+        class KeyStoneUnauthorized(object):
+            pass
+
         class EmptyCatalog(object):
             pass
 
@@ -145,6 +156,115 @@ class OSCredentials(object):
         self.project_domain_id = project_domain_id
 
 
+class HttpSettings(object):
+    """Pooling and timeouts of the HTTP session shared by the clients
+
+    Values not given (e.g. by the cloud record) are taken from the shell
+    (minicloud.rc), else defaulted.
+    """
+
+    def __init__(self, pool_size=None, connect_timeout=None,
+                 read_timeout=None, keepalive=None):
+        self.pool_size = int(
+            pool_size or shell_variable('MINICLOUD_HTTP_POOL_SIZE', 32))
+        self.connect_timeout = float(
+            connect_timeout or
+            shell_variable('MINICLOUD_HTTP_CONNECT_TIMEOUT', 10))
+        self.read_timeout = float(
+            read_timeout or shell_variable('MINICLOUD_HTTP_READ_TIMEOUT', 60))
+        if keepalive is None:
+            keepalive = shell_variable('MINICLOUD_HTTP_KEEPALIVE', 'yes')
+        self.keepalive = str(keepalive).lower() not in ('0', 'false', 'no',
+                                                        'off')
+
+
+class PoolingAdapter(requests.adapters.HTTPAdapter):
+    """HTTP adapter applying the HTTP settings, and counting its usage"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        super(PoolingAdapter, self).__init__(
+            pool_connections=settings.pool_size,
+            pool_maxsize=settings.pool_size)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = (self.settings.connect_timeout,
+                                 self.settings.read_timeout)
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return super(PoolingAdapter, self).send(request, **kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        pools = [self.poolmanager.pools[key]
+                 for key in self.poolmanager.pools.keys()]
+        return dict(pool_size=self.settings.pool_size,
+                    requests=self.requests, in_flight=self.in_flight,
+                    peak_in_flight=self.peak_in_flight, pools=len(pools),
+                    connections=sum(pool.num_connections for pool in pools))
+
+
+class TokenCache(object):
+    """On-disk cache of Keystone tokens, together with their catalog
+
+    Tokens are keyed by auth url, user, project and domains, and are only
+    reused as long as they are not about to expire.
+    """
+
+    STALE_DURATION = 60  # secs
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def __repr__(self):
+        return 'Token cache'
+
+    @staticmethod
+    def key(credentials):
+        return hashlib.sha256('\n'.join((
+            credentials.auth_url, credentials.username,
+            credentials.project_name, credentials.user_domain_id or '',
+            credentials.project_domain_id or '')).encode('utf-8')).hexdigest()
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self, credentials, auth):
+        state = self.read().get(self.key(credentials))
+        if state:
+            auth.set_auth_state(state)
+            if auth.auth_ref and not auth.auth_ref.will_expire_soon(
+                    self.STALE_DURATION):
+                trace('[{}] reusing token for {}', self, credentials.username)
+                return True
+            auth.invalidate()
+        return False
+
+    def save(self, credentials, auth):
+        state = auth.get_auth_state()
+        if state:
+            tokens = self.read()
+            tokens[self.key(credentials)] = state
+            try:
+                write_private_file(self.path, json.dumps(tokens))
+            except (IOError, OSError) as e:
+                warn('Could not write token cache {}: {}', self.path, e)
+
+
 class Keystone(object):
 
     def __init__(self, session=None, credentials=None):
@@ -271,6 +391,21 @@ class Glance(object):
 
 
 class Neutron(object):
+    PAGE_SIZE = int(shell_variable('MINICLOUD_NEUTRON_PAGE_SIZE', 500))
+
+    # the attributes minicloud reads, per collection ; listings only fetch
+    # these
+    FIELDS = {
+        'ports': ('id', 'device_id', 'network_id', 'device_owner',
+                  'fixed_ips', 'binding:profile'),
+        'networks': ('id', 'name', 'router:external'),
+        'subnets': ('id', 'name', 'network_id', 'cidr'),
+        'routers': ('id', 'name', 'external_gateway_info'),
+        'floatingips': ('id', 'floating_network_id', 'floating_ip_address',
+                        'fixed_ip_address', 'port_id'),
+        'security_groups': ('id', 'name', 'description')
+    }
+
     def __init__(self, session=None, credentials=None):
         if session:
             self.client = neutron_client.Client('2.0', session=session)
@@ -306,74 +441,77 @@ class Neutron(object):
             router_names.append(router['name'])
         return router_names
 
-    def routers(self, name=None, router_id=None):
+    def iter_collection(self, collection, **params):
+        # walks the collection page by page (limit and marker), yielding the
+        # resources as their page arrives ; params with None value are unset
+        # resources are projected on the collection FIELDS, unless fields are
+        # passed explicitly (fields=None fetches them in full)
+        list_f = getattr(self.client, 'list_' + collection)
+        params.setdefault('fields', self.FIELDS.get(collection))
+        params = dict((k, v) for k, v in params.items() if v is not None)
         try:
-            if router_id:
-                return self.client.list_routers(id=router_id)['routers']
-            elif name:
-                return self.client.list_routers(name=name)['routers']
-            else:
-                return self.client.list_routers()['routers']
+            for page in list_f(retrieve_all=False, limit=self.PAGE_SIZE,
+                               **params):
+                for resource in page[collection]:
+                    yield resource
         except KeyStoneHttpNotFound as e:
-            exc_error('[{}] Router api failure: {}', self, e)
+            exc_error('[{}] Neutron api failure: {}', self, e)
             raise HttpAccessException
 
+    def iter_routers(self, name=None, router_id=None):
+        return self.iter_collection('routers', id=router_id, name=name)
+
+    def routers(self, name=None, router_id=None):
+        return list(self.iter_routers(name, router_id))
+
+    def iter_networks(self, name=None, net_id=None):
+        return self.iter_collection('networks', id=net_id, name=name)
+
     def networks(self, name=None, net_id=None):
-        try:
-            if net_id:
-                return self.client.list_networks(id=net_id)['networks']
-            elif name:
-                return self.client.list_networks(name=name)['networks']
-            else:
-                return self.client.list_networks()['networks']
-        except KeyStoneHttpNotFound as e:
-            exc_error('[{}] Network api failure: {}', self, e)
-            raise HttpAccessException
+        return list(self.iter_networks(name, net_id))
 
     def subnets(self, network_id=None):
+        return list(self.iter_collection('subnets', network_id=network_id))
+
+    def changed(self, collection, since, with_ids=True):
+        # relies on the timestamp extension ; returns the resources changed
+        # since given time and, if requested, the ids of all resources
         try:
-            if network_id:
-                return self.client.list_subnets(
-                    network_id=network_id)['subnets']
-            else:
-                return self.client.list_subnets()['subnets']
-        except KeyStoneHttpNotFound as e:
-            exc_error('[{}] Subnet api failure: {}', self, e)
-            raise HttpAccessException
+            changed = list(self.iter_collection(collection,
+                                                changed_since=since))
+            ids = set(resource['id'] for resource in self.iter_collection(
+                collection, fields='id')) if with_ids else None
+            return changed, ids
+        except BadRequest as e:
+            trace('[{}] No changed {} support: {}', self, collection, e)
+            return None
+
+    @staticmethod
+    def is_standalone(port):
+        return (not port['device_owner'] or
+                # i think below criterium are lost ports whose vm was
+                # destroyed
+                # ------------------- cover compute:nova and :ironic
+                (port['device_owner'].startswith('compute') or
+                 port['device_owner'] == 'nuage:vip') and
+                not port['binding:profile'] or
+                # TODO(Kris) i have no clue what this ...
+                port['device_owner'] == 'compute:None')
 
     def ports(self, network_id=None, device_id=None, standalone_only=False):
         trace('[{}] ports [{}] [{}] [{}]', self,
               network_id if network_id else ' ',
               device_id if device_id else ' ',
               standalone_only if standalone_only else ' ')
-        if device_id and network_id:
-            return self.client.list_ports(
-                device_id=device_id, network_id=network_id)['ports']
-        elif device_id:
-            return self.client.list_ports(device_id=device_id)['ports']
-        elif network_id:
-            ports = self.client.list_ports(network_id=network_id)['ports']
-        else:
-            ports = self.client.list_ports()['ports']
-        if standalone_only:  # TODO(Kris) Optimize
-            trace('[{}] {} ports found, filtering to standalone',
-                  self, len(ports))
-            sa_ports = []
-            for port in ports:
-                trace('[{}] processing port [{}]', self, port)
-                if (not port['device_owner'] or
-                        # i think below criterium are lost ports whose vm was
-                        # destroyed
-                        # ------------------- cover compute:nova and :ironic
-                        (port['device_owner'].startswith('compute') or
-                         port['device_owner'] == 'nuage:vip') and
-                        not port['binding:profile'] or
-                        # TODO(Kris) i have no clue what this ...
-                        port['device_owner'] == 'compute:None'):
-                    sa_ports.append(port)
+        ports = self.iter_collection('ports', device_id=device_id,
+                                     network_id=network_id)
+        if standalone_only and not device_id:
+            # filtered page by page, as the pages arrive
+            sa_ports = [port for port in ports if self.is_standalone(port)]
             trace('[{}] {} standalone ports', self, len(sa_ports))
             return sa_ports
         else:
+            ports = list(ports)
             trace('[{}] {} ports found, standalone was not set',
                   self, len(ports))
             return ports
@@ -439,6 +577,26 @@ class Neutron(object):
     def delete_port(self, port_id):
         self.delete_resource(self.client.delete_port, port_id)
 
+    def delete_ports(self, port_ids, max_workers=None):
+        # deletes the ports concurrently, on a bounded pool ; returns the
+        # (port id, error) pairs of the ports which failed, while ports not
+        # found are taken as deleted
+        def delete(port_id):
+            try:
+                self.client.delete_port(port_id)
+            except NotFound:
+                trace('[{}] Port [{}] was deleted already', self, port_id)
+            except InternalServerError as e:
+                warn_n('InternalServerError when deleting port: {}', e)
+                # but, silently pass for now...
+            except Conflict as e:
+                return port_id, IntegrityException(str(e))
+            except Exception as e:
+                return port_id, e
+
+        return [failure for failure in parallel_map(
+            delete, port_ids, max_workers) if failure]
+
     def add_router_interface(self, router_id, subnet_id):
         add_itf = {'subnet_id': subnet_id}
         try:
@@ -452,12 +610,11 @@ class Neutron(object):
         self.delete_resource(self.client.remove_interface_router,
             router_id, add_itf)
 
+    def iter_security_groups(self, name=None):
+        return self.iter_collection('security_groups', name=name)
+
     def security_groups(self, name=None):
-        if name:
-            return self.client.list_security_groups(name=name)[
-                'security_groups']
-        else:
-            return self.client.list_security_groups()['security_groups']
+        return list(self.iter_security_groups(name))
 
     def create_sg(self, name, description):
         sg = {'name': name, 'description': description}
@@ -479,15 +636,8 @@ class Neutron(object):
             {'security_group_rule': sg_rule})['security_group_rule']
 
     def floating_ips(self, fixed_ip=None, fip_id=None):
-        if fip_id:
-            floating_ips = self.client.list_floatingips(
-                id=fip_id)['floatingips']
-        elif fixed_ip:
-            floating_ips = self.client.list_floatingips(
-                fixed_ip_address=fixed_ip)['floatingips']
-        else:
-            floating_ips = self.client.list_floatingips()['floatingips']
-        return floating_ips
+        return list(self.iter_collection('floatingips', id=fip_id,
+                                         fixed_ip_address=fixed_ip))
 
     def allocate_floating_ip(self, network_id, port_id=None):
         try:
@@ -555,6 +705,21 @@ class Nova(object):
             exc_error('[{}] Nova api failure: {}', self, e)
             raise HttpAccessException
 
+    def changed_servers(self, since):
+        # includes the servers deleted since, with status DELETED
+        try:
+            return self.client.servers.list(
+                search_opts={'changes-since': since})
+        except NovaBadRequest as e:
+            trace('[{}] No changed servers support: {}', self, e)
+            return None
+        except EmptyCatalog as e:
+            exc_error('[{}] Nova catalog exception: {}.', self, e)
+            raise AuthorizationException
+        except KeyStoneHttpNotFound as e:
+            exc_error('[{}] Nova api failure: {}', self, e)
+            raise HttpAccessException
+
     def server(self, server_id):
         return self.client.servers.get(server_id)
 
@@ -596,13 +761,49 @@ class Nova(object):
 
         return instance
 
+    BOOT_LIST_RETRIES = 3  # as the servers may list after their boot
+
+    def boot_many(self, name, count, image, flavor, sg_names=None,
+                  network_id=None, meta=None):
+        # boots count servers in one multi-create request, and reads them
+        # back in one list on their reservation id ; returns the servers
+        # found, which may be fewer than count
+        nics = [{'net-id': network_id}] if network_id else None
+
+        try:
+            trace('Booting {} servers: [name: {}] [image: {}] '
+                  '[flavor: {}] [sg: {}] [nics: {}]',
+                  count, name, image, flavor,
+                  sg_names[0] if sg_names else '-', nics)
+            # with reservation_id set, create() returns the reservation id
+            reservation_id = self.client.servers.create(
+                name, image, flavor, security_groups=sg_names,
+                nics=nics, meta=meta, min_count=count, max_count=count,
+                reservation_id=True)
+            servers = []
+            for retry in range(self.BOOT_LIST_RETRIES):
+                if retry:
+                    time.sleep(1)
+                servers = self.client.servers.list(
+                    search_opts={'reservation_id': reservation_id})
+                if len(servers) >= count:
+                    break
+        except NovaForbidden as f:
+            exc_error('[{}] Nova boot forbidden: {}.', self, f)
+            raise MiniCloudException
+        except NovaClientException as nce:
+            exc_error('[{}] Nova boot exception: {}.', self, nce)
+            raise MiniCloudException
+
+        return sorted(servers, key=lambda server: server.name)
+
     def delete(self, server):
         self.client.servers.delete(server)
 
 
 class OSClient(object):
     def __init__(self, auth_url, username, project_name, password,
-                 user_domain_id, project_domain_id):
+                 user_domain_id, project_domain_id, http_settings=None):
 
         # fix auth_url if it does not hold v3 - TODO(KRIS) any other way?
         if auth_url[-2:] != 'v3' and auth_url[-2:] != 'v2':
@@ -617,7 +818,13 @@ class OSClient(object):
         self._nova = None
         self._neutron = None
         self._authenticated = None
+        self._authentication_failure = None
         self.session = None
+        self.client_locks = dict((client, threading.Lock()) for client in
+                                 ('keystone', 'glance', 'nova', 'neutron'))
+        self.token_cache = TokenCache(TOKEN_CACHE) if TOKEN_CACHE else None
+        self.http_settings = http_settings or HttpSettings()
+        self.http_adapter = None
 
         self.authenticate()
 
@@ -637,14 +844,22 @@ class OSClient(object):
                 user_domain_id=self._me.user_domain_id,
                 project_domain_id=self._me.project_domain_id)
 
+            # a cached token which is still valid saves the round-trip
+            cached = self.token_cache is not None and \
+                self.token_cache.load(self._me, auth)
+
             # session.Session(auth=auth, verify='/path/to/ca.cert')
-            self.session = keystone_session.Session(auth=auth, verify=False)
-            self._authenticated = self.keystone().authentication_success
+            self.session = keystone_session.Session(
+                auth=auth, verify=False, session=self.http_session())
             try:
-                # verify the authentication
-                self._authenticated &= self.keystone().endpoints is not None
-                assert self._authenticated
-                _('OK', CLOSE)
+                # verify the authentication, by obtaining the token (which
+                # comes with the catalog) ; no admin rights are needed
+                self._authenticated = cached or self.verify_token()
+                if self._authenticated:
+                    _('OK', CLOSE)
+                    if self.token_cache is not None and not cached:
+                        self.token_cache.save(self._me, auth)
+                    self.init_clients()
 
             except KeyStoneHttpNotFound:
                 _('... Reverting to v2', CLOSE)
@@ -659,6 +874,7 @@ class OSClient(object):
                     self.keystone().get_token() is not None
                 assert self._authenticated
                 _('... v2 Token check OK', CLOSE)
+                self.init_clients()
 
             except KeyStoneConnectionFailure as e:
                 output()
@@ -666,46 +882,81 @@ class OSClient(object):
                      str(e))
                 self._authenticated = False
 
-        return self._authenticated, self.keystone().authentication_failure
+        return self._authenticated, self._authentication_failure or \
+            self.keystone().authentication_failure
+
+    def http_session(self):
+        session = requests.Session()
+        self.http_adapter = PoolingAdapter(self.http_settings)
+        session.mount('https://', self.http_adapter)
+        session.mount('http://', self.http_adapter)
+        if not self.http_settings.keepalive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def http_statistics(self):
+        return self.http_adapter.stats() if self.http_adapter else {}
+
+    def verify_token(self):
+        try:
+            return self.session.auth.get_access(self.session) is not None
+        except (KeyStoneAuthorizationFailure, KeyStoneUnauthorized) as e:
+            self._authentication_failure = e
+            return False
+
+    def init_clients(self):
+        # the catalog is known now, so build the clients all together
+        parallel_map(lambda client: client(),
+                     (self.keystone, self.nova, self.neutron, self.glance))
 
     def keystone(self, v2=False):
         if not self._keystone or v2 and not self._v2:
-            _('... Initializing Keystone client (' + ('v2)' if v2 else 'v3)'))
-            if v2:
-                self._keystone = Keystone(credentials=self._me)
-            else:
-                self._keystone = Keystone(self.session)
-            self._v2 = v2
-            __()
+            with self.client_locks['keystone']:
+                if not self._keystone or v2 and not self._v2:
+                    _('... Initializing Keystone client (' +
+                      ('v2)' if v2 else 'v3)'))
+                    if v2:
+                        self._keystone = Keystone(credentials=self._me)
+                    else:
+                        self._keystone = Keystone(self.session)
+                    self._v2 = v2
+                    __()
         return self._keystone
 
     def glance(self):
         if not self._glance:
-            _('... Initializing Glance client ')
-            if self._v2:
-                self._glance = Glance(endpoint=self._keystone.image_url,
-                                      token=self._keystone.auth_token)
-            else:
-                self._glance = Glance(self.session)
-            __()
+            with self.client_locks['glance']:
+                if not self._glance:
+                    _('... Initializing Glance client ')
+                    if self._v2:
+                        self._glance = Glance(
+                            endpoint=self._keystone.image_url,
+                            token=self._keystone.auth_token)
+                    else:
+                        self._glance = Glance(self.session)
+                    __()
         return self._glance
 
     def nova(self):
         if not self._nova:
-            _('... Initializing Nova client ')
-            if self._v2:
-                self._nova = Nova(credentials=self._me)
-            else:
-                self._nova = Nova(self.session)
-            __()
+            with self.client_locks['nova']:
+                if not self._nova:
+                    _('... Initializing Nova client ')
+                    if self._v2:
+                        self._nova = Nova(credentials=self._me)
+                    else:
+                        self._nova = Nova(self.session)
+                    __()
         return self._nova
 
     def neutron(self):
         if not self._neutron:
-            _('... Initializing Neutron client ')
-            if self._v2:
-                self._neutron = Neutron(credentials=self._me)
-            else:
-                self._neutron = Neutron(self.session)
-            __()
+            with self.client_locks['neutron']:
+                if not self._neutron:
+                    _('... Initializing Neutron client ')
+                    if self._v2:
+                        self._neutron = Neutron(credentials=self._me)
+                    else:
+                        self._neutron = Neutron(self.session)
+                    __()
         return self._neutron
@@ -1,4 +1,8 @@
+import time
+
 from entity_manager import EntityManager, EntityManagerImpl
+from core_cache import CachePolicy, CacheStats, EntityIndex, NegativeCache,\
+    ReadWriteLock, SingleFlight, SortedView
 from core_types import IntegrityException
 from core_out import debug, error, info, output, trace
 from core_utils import trace_enabled
@@ -9,12 +13,34 @@ __author__ = 'Kris Sterckx'
 
 
 class CachedEntityManager(EntityManager):
-    def __init__(self, never_clear_cache_f=None, *args, **kwargs):
+    NEGATIVE_CACHE_SIZE = 256
+    NEGATIVE_CACHE_TTL = 30  # secs
+
+    # bumped whenever the outcome of never_clear_cache() may change
+    policy_generation = 0
+
+    def __init__(self, never_clear_cache_f=None, write_through=True,
+                 *args, **kwargs):
         super(CachedEntityManager, self).__init__(*args, **kwargs)
 
         self.cache_is_filled = False
         self.entity_cache = {}
+        self.cache_stamps = {}
+        self.fill_stamp = None
+        self.cache_policy = CachePolicy()
+        self.parent_index = EntityIndex(self.entity_parent_name)
+        self.indexes = dict((index, EntityIndex(key_f)) for index, key_f
+                            in self.entity_indexes().items())
+        self.sorted_view = SortedView(self.sort_key)
+        self.negative_cache = NegativeCache(self.NEGATIVE_CACHE_SIZE,
+                                            self.NEGATIVE_CACHE_TTL)
         self.never_clear_cache_f = never_clear_cache_f
+        self.never_clear_cache_memo = None  # (policy generation, outcome)
+        self.pending_snapshot = None
+        self.cache_stats = CacheStats()
+        self.cache_lock = ReadWriteLock()
+        self.sync_flight = SingleFlight()  # coalesces concurrent full syncs
+        self.write_through = write_through
 
     @staticmethod
     def entity_name():
@@ -22,10 +48,46 @@ class CachedEntityManager(EntityManager):
 
     def set_never_clear_cache(self, f):
         self.never_clear_cache_f = f
+        self.never_clear_cache_memo = None
+
+    def set_cache_policy(self, policy):
+        self.cache_policy = policy
+
+    def set_write_through(self, write_through=True):
+        self.write_through = write_through
 
     def never_clear_cache(self):
-        return (self.never_clear_cache_f is not None and
-                self.never_clear_cache_f())
+        if self.never_clear_cache_f is None:
+            return False
+        generation = CachedEntityManager.policy_generation
+        if (self.never_clear_cache_memo is None or
+                self.never_clear_cache_memo[0] != generation):
+            self.never_clear_cache_memo = (generation,
+                                           self.never_clear_cache_f())
+        return self.never_clear_cache_memo[1]
+
+    @staticmethod
+    def invalidate_policies():
+        CachedEntityManager.policy_generation += 1
+
+    def list(self, deep_list=False, fetch_cache_only=False,
+             trust_cache_when_filled=False,
+             name=None, parent_name=None):
+        # what a sync listed is returned, not the whole cache, which may
+        # hold more when never cleared ; served from the cache, the list is
+        # the sorted view already, so sorting it again is linear
+        return self.sort_list(self.unsorted_list(
+            deep_list, fetch_cache_only, trust_cache_when_filled,
+            name, parent_name))
+
+    def sorted_list(self):
+        with self.cache_lock.reading():
+            return [self.entity_cache[name]
+                    for name in self.sorted_view.names()]
+
+    def cached_entities(self):
+        with self.cache_lock.reading():
+            return list(self.entity_cache.values())
 
     def unsorted_list(self, deep_list=False, fetch_cache_only=False,
                       trust_cache_when_filled=False,
@@ -36,24 +98,30 @@ class CachedEntityManager(EntityManager):
         deep_list = deep_list and not trust_cache_when_filled and \
             not self.trust_cache_when_filled()
 
+        if not deep_list and not fetch_cache_only and \
+                not trust_cache_when_filled and \
+                self.is_cache_filled() and self.fill_expired():
+            debug('[{}] list() cache has expired.', self)
+            deep_list = True
+
         if fetch_cache_only or self.cache_is_filled and not deep_list:
+            self.cache_stats.hit()
             if name:
-                if name in self.entity_cache:
+                entity = self.entity_cache.get(name)
+                if entity:
                     debug('[{}] list [name={}] is cache hit.',
                           self, name)
 
-                    _list = self.entity_cache[name]
+                    _list = entity
 
             elif parent_name:
-                for e in self.entity_cache.values():
-                    if e.is_child(parent_name):
-                        _list.append(e)
+                _list = self.cached_children(parent_name)
 
                 debug('[{}] list [parent_name={}] is yielding {} {}{} '
                       'from cache.', self, parent_name, len(_list),
                       self.entity_name(), 's' if len(_list) > 1 else '')
             else:
-                _list = self.entity_cache.values()
+                _list = self.sorted_list()
 
                 debug('[{}] list() is yielding {} {}{} from cache.',
                       self, len(_list), self.entity_name(),
@@ -62,6 +130,7 @@ class CachedEntityManager(EntityManager):
             debug('[{}] list() is executing deep fetch{}.', self,
                   ' (deep_list)' if deep_list else '')
 
+            self.cache_stats.miss()
             _list = self.full_sync(deep_list)
 
         self.trace_dump(_list)
@@ -71,14 +140,61 @@ class CachedEntityManager(EntityManager):
         if not self.is_cache_filled():
             self.full_sync()
 
-        if parent_name:
-            cnt = 0
-            for e in self.entity_cache.values():
-                if e.is_child(parent_name):
-                    cnt += 1
-            return cnt
+        with self.cache_lock.reading():
+            if parent_name:
+                return self.parent_index.count(parent_name)
+            else:
+                return len(self.entity_cache)
+
+    def cached_children(self, parent_name):
+        with self.cache_lock.reading():
+            return [self.entity_cache[name]
+                    for name in self.parent_index.names(parent_name)]
+
+    def sync_for_lookup(self, deep_list=False):
+        # brings the cache in line before an index lookup, when needed
+        if deep_list or not self.is_cache_filled() or self.fill_expired():
+            self.unsorted_list(deep_list)
         else:
-            return len(self.entity_cache)
+            self.cache_stats.hit()
+
+    def children(self, parent_name, deep_list=False):
+        # the entities of given parent, looked up in the parent index
+        self.sync_for_lookup(deep_list)
+        return self.sort_list(self.cached_children(parent_name))
+
+    def indexed(self, index_name, key, deep_list=False):
+        # the entities with given key, looked up in a secondary index ; the
+        # cache is synced first when needed
+        self.sync_for_lookup(deep_list)
+
+        index = self.indexes[index_name]
+        with self.cache_lock.reading():
+            entities = [self.entity_cache[name] for name in index.names(key)]
+        if not entities and index.unkeyed:
+            # entities get their key after being cached (e.g. the ip of a
+            # booting instance), so have the unkeyed ones re-indexed
+            with self.cache_lock.writing():
+                for name in list(index.unkeyed):
+                    index.add(self.entity_cache[name])
+                entities = [self.entity_cache[name]
+                            for name in index.names(key)]
+
+        # keys may have changed since indexed ; those entities are reindexed
+        found, stale = [], []
+        for entity in entities:
+            (found if index.key_f(entity) == key else stale).append(entity)
+        if stale:
+            with self.cache_lock.writing():
+                for entity in stale:
+                    if self.entity_cache.get(entity.name) is entity:
+                        index.add(entity)
+        return self.sort_list(found)
+
+    @staticmethod
+    def entity_parent_name(entity):
+        return entity.parent_name() if hasattr(entity, 'parent_name') \
+            else None
 
     def get(self, name):
         return self.cached_get(name)
@@ -91,14 +207,30 @@ class CachedEntityManager(EntityManager):
             name, override_cache=not self.never_clear_cache())
 
     def cached_get(self, name, override_cache=False):
+        if self.pending_snapshot is not None and \
+                name not in self.entity_cache and self.fill_from_snapshot():
+            return self.cached_get(name, override_cache)
+
+        if not override_cache and name in self.entity_cache and \
+                self.entry_expired(name):
+            debug('[{}] get({}) cache entry has expired', self, name)
+            override_cache = True
+
         if override_cache or name not in self.entity_cache:
             if self.is_cache_filled() and not override_cache:
                 debug('[{}] get({}) not found in cache', self, name)
+                self.cache_stats.hit()
 
                 # this is it, it ain't there
                 return None
 
+            elif not override_cache and self.negative_cache.hit(name):
+                debug('[{}] get({}) is known not to exist', self, name)
+                self.cache_stats.hit()
+                return None
+
             else:
+                self.cache_stats.miss()
                 debug('[{}] get({}) not {} cache ({})',
                       self, name,
                       'searched in' if override_cache else 'found in',
@@ -118,6 +250,9 @@ class CachedEntityManager(EntityManager):
 
             else:
                 debug('[{}] get({}) has no entry found.', self, name)
+                if override_cache:
+                    self.uncache_entity(name)
+                self.negative_cache.add(name)
                 debug('[{}] still filling up cache now.', self)
 
                 trace('[{}] get() -> full_sync', self)
@@ -126,7 +261,10 @@ class CachedEntityManager(EntityManager):
 
         else:
             # cache hit
-            entity = self.entity_cache[name]
+            self.cache_stats.hit()
+            entity = self.entity_cache.get(name)
+            if entity is None:  # uncached meanwhile
+                return None
             debug('[{}] get({}) is cache hit: {}',
                   self, name, entity.repr())
 
@@ -134,7 +272,26 @@ class CachedEntityManager(EntityManager):
         return entity
 
     def full_sync(self, deep_list=False, exclude_entity=None):
-        if deep_list or not self.is_cache_filled():
+        # concurrent syncs are coalesced into the one in flight
+        return self.sync_flight.run(
+            (deep_list, exclude_entity.name if exclude_entity else None),
+            self.do_full_sync, deep_list, exclude_entity)
+
+    def do_full_sync(self, deep_list=False, exclude_entity=None):
+        if not deep_list and self.pending_snapshot is not None and \
+                self.fill_from_snapshot():
+            trace('[{}] full_sync() completed from snapshot', self)
+            return self.cached_entities()
+
+        elif deep_list and self.is_cache_filled() and not exclude_entity and \
+                self.delta_sync():
+            # the cache is brought up to date without re-listing
+            self.cache_stats.synced('delta')
+            self.fill_stamp = self.cache_policy.stamp()
+            trace('[{}] full_sync() completed by delta_sync()', self)
+            return self.cached_entities()
+
+        elif deep_list or not self.is_cache_filled():
             if trace_enabled():
                 trace('[{}] -- full_sync() -- '
                       '[deep_list={}] [exclude_entity={}]',
@@ -143,15 +300,23 @@ class CachedEntityManager(EntityManager):
             else:
                 info('[{}] full_sync()', self)
 
-            if not exclude_entity:
-                self.clear_cache()
+            if deep_list:
+                self.cache_stats.synced('deep')
+            else:
+                self.cache_stats.synced('shallow')
 
-            entity_list = self.list_entities(deep_list=deep_list,
-                                             exclude_entity=exclude_entity)
-            for entity in entity_list:
-                self.add_to_cache(entity, False)
+            # fetch first, so readers are served by the cache meanwhile
+            entity_list = self.fetch_entities(deep_list=deep_list,
+                                              exclude_entity=exclude_entity)
+            with self.cache_lock.writing():
+                if not exclude_entity:
+                    self.clear_cache()
+                self.negative_cache.clear()  # the listing is authoritative
 
-            self.set_cache_filled()
+                for entity in entity_list:
+                    self.add_to_cache(entity, False)
+
+                self.set_cache_filled()
 
             trace('[{}] -- full_sync() -- (end)', self)
             return entity_list
@@ -159,13 +324,21 @@ class CachedEntityManager(EntityManager):
             trace('[{}] full_sync() is no-op', self)
             return None
 
+    def delta_sync(self):
+        # applies the changes since the last sync to the cache, returning
+        # whether that succeeded; when not, a full re-list is done instead
+        return False  # not supported by default
+
     def add(self, entity, skip_check=False):
         debug('[{}] --- adding {} ---', self, entity.repr())
         name = entity.name
         if name:
             if skip_check or not self.get(name):
                 entity = self.add_entity(entity)
-                self.add_to_cache(entity, True)
+                if self.write_through:
+                    self.write_to_cache(entity)
+                else:
+                    self.add_to_cache(entity, True)
                 debug('[{}] --- adding end ---', self)
                 return entity
             else:
@@ -193,14 +366,36 @@ class CachedEntityManager(EntityManager):
     def boolean_entity_remove(self, entity, cleanup=True):
         if entity:
             removed = self.remove_entity(entity) if cleanup else True
-            if removed and entity.name in self.entity_cache:  # robustness
-                del self.entity_cache[entity.name]
+            if removed:
+                self.uncache_entity(entity.name)
             return removed
         else:
             return False
 
+    def cache_entity(self, entity, stamp=None):
+        with self.cache_lock.writing():
+            self.entity_cache[entity.name] = entity
+            self.cache_stamps[entity.name] = \
+                stamp or self.cache_policy.stamp()
+            self.parent_index.add(entity)
+            for index in self.indexes.values():
+                index.add(entity)
+            self.sorted_view.add(entity)
+            self.negative_cache.invalidate(entity.name)
+
+    def uncache_entity(self, name):
+        with self.cache_lock.writing():
+            self.negative_cache.invalidate(name)
+            if name in self.entity_cache:  # robustness
+                del self.entity_cache[name]
+                del self.cache_stamps[name]
+                self.parent_index.remove(name)
+                for index in self.indexes.values():
+                    index.remove(name)
+                self.sorted_view.remove(name)
+
     def add_to_cache(self, entity, complete_full_cache=False):
-        self.entity_cache[entity.name] = entity
+        self.cache_entity(entity)
         trace('[{}] {} {} added to cache',
               self, entity.name, self.entity_name())
         if complete_full_cache:
@@ -209,17 +404,63 @@ class CachedEntityManager(EntityManager):
         else:
             self.set_cache_filled()
 
+    def fill_cache(self, entities, cached_at=None):
+        stamp = self.cache_policy.stamp(cached_at)
+        with self.cache_lock.writing():
+            for entity in entities:
+                self.cache_entity(entity, stamp)
+            self.set_cache_filled()
+            self.fill_stamp = stamp
+
+    def replace_cache(self, entities, cached_at=None):
+        # the cache then holds given entities only ; the others are uncached
+        # one by one, as clear_cache() keeps them when never clearing
+        names = set(entity.name for entity in entities)
+        with self.cache_lock.writing():
+            for name in [name for name in self.entity_cache
+                         if name not in names]:
+                self.uncache_entity(name)
+            self.fill_cache(entities, cached_at)
+
+    def write_to_cache(self, entity):
+        # write-through : the added entity is known, so only store it; when
+        # the cache is not filled yet, it is filled (once) by the next list
+        self.cache_entity(entity)
+        trace('[{}] {} {} written through to cache',
+              self, entity.name, self.entity_name())
+        if not self.is_cache_filled():
+            debug('[{}] cache fill is deferred.', self)
+
     def update_entity_cache(self, entity):
-        self.entity_cache[entity.name] = entity
+        self.cache_entity(entity)
         debug('[{}] {} {} updated in cache',
               self, entity.name, self.entity_name())
 
     def is_cache_filled(self):
         return self.cache_is_filled
 
+    # the policy is asked first : never_clear_cache() may list this very
+    # manager (the cloud manager, for its stub cloud), which must not get
+    # here again then
+
+    def entry_expired(self, name):
+        return self.cache_policy.expired(self.cache_stamps.get(name)) and \
+            not self.never_clear_cache()
+
+    def fill_expired(self):
+        return self.cache_policy.expired(self.fill_stamp) and \
+            not self.never_clear_cache()
+
+    def expire_cache(self):
+        # generation-based expiry : all entries cached so far are expired
+        self.cache_policy.expire_all()
+        debug('[{}] cache is expired.', self)
+
     def set_cache_filled(self):
         if not self.is_cache_filled():
-            self.cache_is_filled = True
+            with self.cache_lock.writing():
+                self.cache_is_filled = True
+                self.fill_stamp = self.cache_policy.stamp()
             if trace_enabled():
                 trace('[{}] cache is filled ({}).', self, ', '.
                       join(str(e)for e in self.entity_cache))
@@ -228,8 +469,15 @@ class CachedEntityManager(EntityManager):
 
     def clear_cache(self):
         if self.is_cache_filled() and not self.never_clear_cache():
-            self.entity_cache = {}
-            self.cache_is_filled = False
+            with self.cache_lock.writing():
+                self.entity_cache = {}
+                self.cache_stamps = {}
+                self.fill_stamp = None
+                self.parent_index.clear()
+                for index in self.indexes.values():
+                    index.clear()
+                self.sorted_view.clear()
+                self.cache_is_filled = False
             info('[{}] cache is cleared.', self)
 
     def reset(self):
@@ -248,21 +496,63 @@ class CachedEntityManager(EntityManager):
                    thru_silent_mode=True)
         return dropped
 
+    def preload_cache(self, snapshot):
+        # the snapshot fills the cache when it is first needed
+        self.pending_snapshot = snapshot
+
+    def fill_from_snapshot(self):
+        with self.cache_lock.writing():
+            snapshot, self.pending_snapshot = self.pending_snapshot, None
+        if snapshot is not None and not self.is_cache_filled() and \
+                self.restore_cache(snapshot):
+            debug('[{}] cache is filled from snapshot.', self)
+            return True
+        else:
+            return False
+
+    def snapshot_cache(self):
+        return None  # not supported by default
+
+    def restore_cache(self, snapshot):
+        return False  # not supported by default
+
+    def cache_statistics(self):
+        stats = self.cache_stats.as_dict()
+        stats['cached'] = len(self.entity_cache)
+        stats['negative'] = self.negative_cache_stats()
+        return stats
+
+    def negative_cache_stats(self):
+        return dict(hits=self.negative_cache.hits,
+                    misses=self.negative_cache.misses,
+                    size=len(self.negative_cache))
+
+    def entity_indexes(self):
+        return {}  # the secondary indexes, by name : their key function
+
     def trust_cache_when_filled(self):
-        # Can be set by entity manager, by default set ~ never-clear-cache flag
-        return self.never_clear_cache()
+        # Can be set by entity manager through its cache policy, by default
+        # set ~ never-clear-cache flag
+        return self.cache_policy.trusted or self.never_clear_cache()
 
     # METHODS THAT GO UNDERNEATH :
 
     def get_entity(self, name):
         trace('[{}] get_entity({})', self, name)
-        entities = self.list_entities(name)
+        entities = self.fetch_entities(name)
         if entities:
             trace('[{}] get_entity({}) -> {}', self, name, entities[0])
             return entities[0]
         else:
             return None
 
+    def fetch_entities(self, name=None, deep_list=False, exclude_entity=None):
+        start = time.time()
+        entities = self.list_entities(name, deep_list,
+                                      exclude_entity=exclude_entity)
+        self.cache_stats.listed(len(entities), time.time() - start)
+        return entities
+
     @abstractmethod
     def list_entities(self, name=None, deep_list=False, parent_name=None,
                       exclude_entity=None):
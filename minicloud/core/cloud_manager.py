@@ -1,5 +1,7 @@
+import threading
+
 from cached_entity_manager import CachedStoredEntityManager
-from core_out import debug, info
+from core_out import assert_or_fail, debug, info
 
 __author__ = 'Kris Sterckx'
 
@@ -25,7 +27,9 @@ class CloudManager(CachedStoredEntityManager):
     def add(self, named_entity, skip_check=False):
         entity = super(CloudManager, self).add(named_entity)
         if self.is_stub_cloud(entity):
-            CloudManager.stub_cloud_cache = entity
+            with CloudManager.stub_cloud_lock:
+                CloudManager.stub_cloud_cache = entity
+        self.invalidate_policies()
         # add unnamed cluster
         self.minicloud.cluster_manager.add_unnamed_cluster(entity)
         return entity
@@ -33,7 +37,9 @@ class CloudManager(CachedStoredEntityManager):
     def remove(self, entity):
         removed = super(CloudManager, self).remove(entity)
         if removed and self.is_stub_cloud(entity):
-            CloudManager.stub_cloud_cache = 0
+            with CloudManager.stub_cloud_lock:
+                CloudManager.stub_cloud_cache = 0
+        self.invalidate_policies()
         return removed
 
     def type_cast(self, entity):
@@ -44,20 +50,32 @@ class CloudManager(CachedStoredEntityManager):
         return self.minicloud.cluster_manager
 
     stub_cloud_cache = None  # either None (don't know), 0 (no) or stub cloud
+    stub_cloud_lock = threading.Lock()
+    stub_cloud_search = threading.local()  # guards against re-entry
 
     def get_first_stub_cloud(self):
         if CloudManager.stub_cloud_cache is None:
             # note :
-            # one can never get here with a filled cache, which avoids endless
-            # loop in list() call ... as when cache is not filled, the
-            # never_clear_cache is not invoked
-            for cloud in self.list(trust_cache_when_filled=True):
-                if self.is_stub_cloud(cloud):
-                    CloudManager.stub_cloud_cache = cloud
-                    info('[{}] has STUB cloud!', self)
-                    return cloud
-            # no stub found , set to 0
-            CloudManager.stub_cloud_cache = 0
+            # the listing below may not invoke never_clear_cache, or it would
+            # loop back to here ; trusting the cache when filled, it checks
+            # no expiry (and an unfilled cache is not checked either)
+            assert_or_fail(not getattr(CloudManager.stub_cloud_search,
+                                       'active', False),
+                           'never_clear_cache invoked by stub cloud search')
+            CloudManager.stub_cloud_search.active = True
+            try:
+                stub_cloud = 0  # no stub found , set to 0
+                for cloud in self.list(trust_cache_when_filled=True):
+                    if self.is_stub_cloud(cloud):
+                        stub_cloud = cloud
+                        info('[{}] has STUB cloud!', self)
+                        break
+            finally:
+                CloudManager.stub_cloud_search.active = False
+
+            with CloudManager.stub_cloud_lock:
+                if CloudManager.stub_cloud_cache is None:  # else, raced
+                    CloudManager.stub_cloud_cache = stub_cloud
 
         return CloudManager.stub_cloud_cache
 
@@ -1,8 +1,12 @@
+import time
+
 from abc import abstractmethod
 
 from cached_entity_manager import CachedEntityManager
+from core_in import shell_variable
 from core_types import MiniCloudException, IntegrityException
 from core_out import debug, error, trace
+from core_utils import parallel_map
 
 __author__ = 'Kris Sterckx'
 
@@ -13,12 +17,16 @@ __author__ = 'Kris Sterckx'
 #
 
 class CloudResourceManager(CachedEntityManager):
+    # clouds listed concurrently
+    MAX_CLOUD_WORKERS = int(shell_variable('MINICLOUD_MAX_CLOUD_WORKERS', 8))
+
     def __init__(self, minicloud):
         from mini_cloud import MiniCloud
 
         super(CloudResourceManager, self).__init__()
         self.minicloud = minicloud
         self.set_never_clear_cache(MiniCloud.never_clear_cache)
+        self.sync_stamps = {}  # cloud name -> time of last full listing
 
     @property
     def username(self):
@@ -59,19 +67,12 @@ class CloudResourceManager(CachedEntityManager):
 
             if clouds:
                 entities = []
-                for cloud in clouds:
-                    ctx = cloud.context()
-                    if ctx and ctx.authenticated():
-                        cloud_entities = self.get_entities(
-                            ctx, name, deep_list)
-
-                        for cloud_entity in cloud_entities:
-                            entity = self.entity(cloud, ctx, cloud_entity)
-                            if (exclude_entity is None or
-                                    exclude_entity.name != entity.name):
-                                if entity and (not parent_name or
-                                               entity.is_child(parent_name)):
-                                    entities.append(entity)
+                for cloud_entities in parallel_map(
+                        lambda cloud: self.list_cloud_entities(
+                            cloud, name, deep_list, parent_name,
+                            exclude_entity),
+                        clouds, self.MAX_CLOUD_WORKERS):
+                    entities.extend(cloud_entities)
 
                 trace('[{}] list_entities(): entities = {}.', self, ', '.join(
                     str(e) for e in entities))
@@ -85,6 +86,137 @@ class CloudResourceManager(CachedEntityManager):
             error('[{}] Failed to list {}s.', self, self.entity_name())
             return list()
 
+    def list_cloud_entities(self, cloud, name=None, deep_list=False,
+                            parent_name=None, exclude_entity=None):
+        entities = []
+        ctx = cloud.context()
+        if ctx and ctx.authenticated():
+            sync_stamp = time.time()
+            try:
+                prefetched = self.prefetch(cloud, ctx, name)
+                cloud_entities = self.get_entities(ctx, name, deep_list)
+
+                for cloud_entity in cloud_entities:
+                    entity = self.new_entity(cloud, ctx, cloud_entity,
+                                             prefetched)
+                    if (exclude_entity is None or
+                            exclude_entity.name != entity.name):
+                        if entity and (not parent_name or
+                                       entity.is_child(parent_name)):
+                            entities.append(entity)
+
+            except MiniCloudException:
+                # the other clouds still get listed
+                error('[{}] Failed to list {}s on {}.',
+                      self, self.entity_name(), cloud.name)
+                return []
+
+            if not name and not parent_name:
+                self.sync_stamps[cloud.name] = sync_stamp
+
+        return entities
+
+    def delta_sync(self):
+        deltas = []
+        for cloud in self.cloud_manager.list():
+            since = self.sync_stamps.get(cloud.name)
+            ctx = cloud.context()
+            if since is None or cloud.is_stubbed() or \
+                    not ctx or not ctx.authenticated():
+                return False  # stub clouds have no changes to tell
+
+            known = {}  # cloud id -> cached entity
+            for entity in self.cached_entities():
+                if self.in_cloud(entity, cloud):
+                    cloud_id = self.cloud_entity_id(entity)
+                    if cloud_id:
+                        known[cloud_id] = entity
+
+            sync_stamp = time.time()
+            try:
+                delta = self.get_changed_entities(ctx, since, set(known))
+            except MiniCloudException:
+                error('[{}] Failed to list changed {}s.',
+                      self, self.entity_name())
+                delta = None
+            self.cache_stats.listed(len(delta[0]) if delta else 0,
+                                    time.time() - sync_stamp)
+            if delta is None:
+                debug('[{}] no delta sync for {}', self, cloud.name)
+                return False
+
+            deltas.append((cloud, ctx, sync_stamp, known, delta))
+
+        for cloud, ctx, sync_stamp, known, (changed, deleted_ids) in deltas:
+            # prefetching pays off from two changed entities on
+            prefetched = self.prefetch(cloud, ctx) \
+                if len(changed) > 1 else None
+            entities = [self.new_entity(cloud, ctx, cloud_entity, prefetched)
+                        for cloud_entity in changed]
+            with self.cache_lock.writing():
+                for entity in filter(None, entities):
+                    cached = known.get(self.cloud_entity_id(entity))
+                    if cached and cached.name != entity.name:  # renamed
+                        self.uncache_entity(cached.name)
+                    self.cache_entity(entity)
+                for cloud_id in deleted_ids:
+                    if cloud_id in known:
+                        self.uncache_entity(known[cloud_id].name)
+
+            self.sync_stamps[cloud.name] = sync_stamp
+            debug('[{}] delta sync for {}: {} changed, {} deleted.', self,
+                  cloud.name, len(changed), len(deleted_ids))
+
+        return True
+
+    def snapshot_cache(self):
+        entities = []
+        for entity in self.cached_entities():
+            cloud = getattr(entity, 'cloud', None)
+            ctx = entity.context()
+            if cloud is not None and not cloud.is_stubbed() and ctx:
+                data = self.snapshot_entity(ctx, entity)
+                if data is not None:
+                    entities.append(dict(cloud=cloud.name, data=data))
+        return dict(time=self.fill_stamp[0], sync_stamps=self.sync_stamps,
+                    entities=entities)
+
+    def restore_cache(self, snapshot):
+        clouds = {}
+        for cloud in self.cloud_manager.list():
+            if cloud.is_stubbed() or cloud.name not in snapshot['sync_stamps']:
+                debug('[{}] snapshot does not cover {}', self, cloud.name)
+                return False
+            clouds[cloud.name] = cloud
+
+        entities = []
+        for item in snapshot['entities']:
+            cloud = clouds.get(item['cloud'])
+            ctx = cloud.context() if cloud else None
+            if ctx and ctx.authenticated():
+                entity = self.restore_entity(cloud, ctx, item['data'])
+                if entity:
+                    entities.append(entity)
+
+        for cloud_name in clouds:
+            self.sync_stamps[cloud_name] = snapshot['sync_stamps'][cloud_name]
+        self.fill_cache(entities, snapshot['time'])
+        return True
+
+    def snapshot_entity(self, ctx, entity):
+        cloud_entity = self.cloud_entity(entity)
+        return ctx.dump_cloud_entity(cloud_entity) \
+            if cloud_entity is not None else None
+
+    def restore_entity(self, cloud, ctx, data):
+        return self.entity(cloud, ctx, ctx.load_cloud_entity(data))
+
+    @staticmethod
+    def in_cloud(entity, cloud):
+        entity_cloud = getattr(entity, 'cloud', None)
+        return entity_cloud is not None and \
+            getattr(entity_cloud, 'name', None) == cloud.name
+
     def add_entity(self, entity):
         try:
             ctx = self.get_context(entity)
@@ -142,6 +274,14 @@ class CloudResourceManager(CachedEntityManager):
     def entity(self, cloud, ctx, cloud_entity):
         pass
 
+    def prefetch(self, cloud, ctx, name=None):
+        # data shared by the entities of a listing, fetched at once ahead
+        # of it ; passed on to new_entity
+        return None
+
+    def new_entity(self, cloud, ctx, cloud_entity, prefetched=None):
+        return self.entity(cloud, ctx, cloud_entity)
+
     @abstractmethod
     def get_entities(self, ctx, name=None, deep_list=False):
         return list()
@@ -150,6 +290,29 @@ class CloudResourceManager(CachedEntityManager):
     def create_entity(self, ctx, entity):
         return entity
 
+    def get_changed_entities(self, ctx, since, known_ids):
+        # returns the cloud entities changed since given time, together with
+        # the cloud ids, out of known_ids, which got deleted; or None when
+        # not supported
+        return None
+
+    def cloud_entity_id(self, entity):
+        return None
+
+    @staticmethod
+    def raw_cloud_id(cloud_entity):
+        # the id of a raw cloud entity : a dict as neutron's, or an object
+        # as nova's or a stub's
+        if cloud_entity is None:
+            return None
+        elif isinstance(cloud_entity, dict):
+            return cloud_entity.get('id')
+        else:
+            return getattr(cloud_entity, 'id', None)
+
+    def cloud_entity(self, entity):
+        return None  # the raw cloud entity, when it can be snapshot
+
     def reconfig_entity(self, ctx, entity, data):
         # no-op by default
         return entity
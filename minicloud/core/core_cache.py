@@ -0,0 +1,446 @@
+import bisect
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+
+__author__ = 'Kris Sterckx'
+
+
+class EntityIndex(object):
+    """Secondary index on a cache, mapping a key onto entity names
+
+    The key is derived from the entity by key_f; entities yielding None are
+    not indexed, but kept track of as unkeyed.
+    """
+
+    def __init__(self, key_f):
+        self.key_f = key_f
+        self.index = {}
+        self.keys = {}  # reverse map : name -> key
+        self.unkeyed = set()
+
+    def add(self, entity):
+        self.remove(entity.name)
+        key = self.key_f(entity)
+        if key is not None:
+            self.index.setdefault(key, set()).add(entity.name)
+            self.keys[entity.name] = key
+        else:
+            self.unkeyed.add(entity.name)
+
+    def remove(self, name):
+        self.unkeyed.discard(name)
+        key = self.keys.pop(name, None)
+        if key is not None:
+            names = self.index[key]
+            names.discard(name)
+            if not names:
+                del self.index[key]
+
+    def names(self, key):
+        return self.index.get(key, ())
+
+    def count(self, key):
+        return len(self.names(key))
+
+    def clear(self):
+        self.index = {}
+        self.keys = {}
+        self.unkeyed = set()
+
+
+class SortedView(object):
+    """Names of cached entities, kept in order of their sort key
+
+    The order is maintained on every add and remove, so it never needs a
+    re-sort.
+    """
+
+    def __init__(self, key_f):
+        self.key_f = key_f
+        self.entries = []  # sorted (key, name) tuples
+        self.keys = {}  # name -> its entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entity):
+        self.remove(entity.name)
+        entry = (self.key_f(entity), entity.name)
+        bisect.insort(self.entries, entry)
+        self.keys[entity.name] = entry
+
+    def remove(self, name):
+        entry = self.keys.pop(name, None)
+        if entry is not None:
+            del self.entries[bisect.bisect_left(self.entries, entry)]
+
+    def names(self):
+        return [name for _, name in self.entries]
+
+    def clear(self):
+        self.entries = []
+        self.keys = {}
+
+
+class NegativeCache(object):
+    """Bounded record of names which were looked up but found not to exist
+
+    Entries expire after ttl seconds; when max_size is reached, the oldest
+    entries are dropped first.
+    """
+
+    def __init__(self, max_size=256, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # name -> time of the failed lookup
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit(self, name):
+        with self.lock:
+            stamp = self.entries.get(name)
+            if stamp is not None:
+                if time.time() - stamp < self.ttl:
+                    self.hits += 1
+                    return True
+                del self.entries[name]  # expired
+            self.misses += 1
+            return False
+
+    def add(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+            self.entries[name] = time.time()
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class LruCache(object):
+    """Dict-like cache holding at most max_size entries
+
+    The least recently used entries are evicted first. When sharing a
+    budget, entries are also evicted as long as the budget is exceeded.
+    """
+
+    def __init__(self, max_size=None, budget=None):
+        self.max_size = max_size
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.sizes = {}  # key -> approximate size, when on a budget
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if budget:
+            budget.register(self)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        value = self.entries.pop(key)
+        self.entries[key] = value  # most recently used now
+        return value
+
+    def __setitem__(self, key, value):
+        self.pop(key)
+        self.entries[key] = value
+        if self.budget:
+            self.sizes[key] = approx_size(value)
+            self.bytes += self.sizes[key]
+            self.budget.used += self.sizes[key]
+        while self.max_size is not None and len(self) > self.max_size:
+            self.evict()
+        if self.budget:
+            self.budget.fit()
+
+    def get(self, key, default=None):
+        if key in self.entries:
+            self.hits += 1
+            return self[key]
+        else:
+            self.misses += 1
+            return default
+
+    def pop(self, key, default=None):
+        if key in self.entries:
+            self.release(key)
+            return self.entries.pop(key)
+        else:
+            return default
+
+    def values(self):
+        return list(self.entries.values())
+
+    def evict(self):
+        key, _ = self.entries.popitem(last=False)
+        self.release(key)
+        self.evictions += 1
+
+    def release(self, key):
+        size = self.sizes.pop(key, 0)
+        self.bytes -= size
+        if self.budget:
+            self.budget.used -= size
+
+    def clear(self):
+        if self.budget:
+            self.budget.used -= self.bytes
+        self.entries.clear()
+        self.sizes = {}
+        self.bytes = 0
+
+    def stats(self):
+        return dict(size=len(self), max_size=self.max_size, bytes=self.bytes,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+class CacheBudget(object):
+    """Cap on the approximate memory taken by a group of LRU caches
+
+    When exceeded, the largest cache of the group gives up its least
+    recently used entries first.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.caches = []
+
+    def register(self, cache):
+        self.caches.append(cache)
+
+    def fit(self):
+        while self.used > self.max_bytes:
+            cache = max(self.caches, key=lambda c: c.bytes)
+            if not cache:
+                break
+            cache.evict()
+
+
+def approx_size(obj):
+    # approximate memory footprint of (nested) builtin containers
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(approx_size(e) for e in obj)
+    return size
+
+
+class CachePolicy(object):
+    """Decides on the lifetime of cached entities
+
+    Entries expire individually, ttl seconds after being cached (no ttl means
+    no time-based expiry), or once the policy generation was moved on past
+    the one they were cached in. A trusted cache, once filled, also answers
+    deep lists.
+    """
+
+    def __init__(self, ttl=None, trusted=False):
+        self.ttl = ttl
+        self.trusted = trusted
+        self.generation = 0
+
+    def __repr__(self):
+        return 'CachePolicy(ttl=%s%s)' % (self.ttl,
+                                          ', trusted' if self.trusted else '')
+
+    def stamp(self, cached_at=None):
+        return (time.time() if cached_at is None else cached_at,
+                self.generation)
+
+    def expired(self, stamp):
+        if stamp is None:
+            return False
+        cached_at, generation = stamp
+        return (generation != self.generation or
+                self.ttl is not None and time.time() - cached_at > self.ttl)
+
+    def expire_all(self):
+        self.generation += 1
+
+
+class CacheStats(object):
+    """Counters on the use of a cache and on the listings filling it
+
+    A hit is a lookup answered from the cache, a miss one which needed a
+    fetch; list_time is the time spent in fetching entity listings. The
+    counters are updated under a lock, as listings run concurrently.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.deep_syncs = 0
+        self.shallow_syncs = 0
+        self.delta_syncs = 0
+        self.fetched = 0
+        self.list_time = 0.0
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def synced(self, kind):
+        # kind is either of deep, shallow or delta
+        with self.lock:
+            setattr(self, kind + '_syncs', getattr(self, kind + '_syncs') + 1)
+
+    def listed(self, fetched, elapsed):
+        with self.lock:
+            self.fetched += fetched
+            self.list_time += elapsed
+
+    def hit_ratio(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return float(self.hits) / lookups if lookups else None
+
+    def as_dict(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        deep_syncs=self.deep_syncs,
+                        shallow_syncs=self.shallow_syncs,
+                        delta_syncs=self.delta_syncs,
+                        fetched=self.fetched, list_time=self.list_time)
+
+
+class ReadWriteLock(object):
+    """Lock allowing concurrent readers or a single writer
+
+    The writer may re-enter, as a writer or as a reader; readers do not
+    upgrade to writers.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None  # the writing thread
+        self.writes = 0  # its reentry depth
+
+    def acquire_read(self):
+        with self.cond:
+            if self.writer is threading.current_thread():
+                self.writes += 1  # read while writing
+                return
+            while self.writer is not None:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            if self.writer is threading.current_thread():
+                self.writes -= 1
+            else:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        with self.cond:
+            if self.writer is me:
+                self.writes += 1
+                return
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.writer = me
+            self.writes = 1
+
+    def release_write(self):
+        with self.cond:
+            self.writes -= 1
+            if not self.writes:
+                self.writer = None
+                self.cond.notify_all()
+
+    def reading(self):
+        return _Held(self.acquire_read, self.release_read)
+
+    def writing(self):
+        return _Held(self.acquire_write, self.release_write)
+
+
+class _Held(object):
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for a same key into one call
+
+    Threads calling while a call for their key is in flight wait for it and
+    share its outcome; a reentrant call, from the calling thread itself, is
+    simply run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}  # key -> _Flight
+
+    def run(self, key, f, *args, **kwargs):
+        me = threading.current_thread()
+        with self.lock:
+            flight = self.flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self.flights[key] = _Flight(me)
+
+        if not leading:
+            if flight.thread is me:
+                return f(*args, **kwargs)
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = f(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+class _Flight(object):
+    def __init__(self, thread):
+        self.thread = thread
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
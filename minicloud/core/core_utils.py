@@ -1,6 +1,9 @@
 from __future__ import print_function
 
+import os
 import sys
+import tempfile
+import threading
 
 __author__ = 'Kris Sterckx'
 
@@ -18,6 +21,43 @@ def is_silent_mode(thru_silent_mode=False):
     return silent_mode and not thru_silent_mode
 
 
+def parallel_map(f, items, max_workers=None):
+    # maps f over items on a bounded thread pool, keeping their order
+    items = list(items)
+    if len(items) < 2 or max_workers == 1:
+        return [f(item) for item in items]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(len(items), max_workers or len(items)))
+    try:
+        return pool.map(f, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_private_file(path, text):
+    # writes to a temp file of its own, readable by the user only, which
+    # then atomically replaces the file ; concurrent writers don't collide
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError:
+            if not os.path.isdir(directory):  # else, raced
+                raise
+    fd, tmp_path = tempfile.mkstemp(dir=directory or '.',  # as 0600
+                                    prefix=os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
 def pop_first(alist):
     if len(alist) > 0:
         return alist[0]
@@ -31,7 +71,8 @@ class Box:
 
 
 __m = Box()
-__m.stack = list()
+__m.progress = threading.local()  # holds the progress stack, per thread
+__m.main_thread = threading.current_thread()
 __m.info = False
 __m.debug = False
 __m.trace = False
@@ -67,14 +108,26 @@ def trace_enabled():
     return __m.trace
 
 
+def progress_stack():
+    if not hasattr(__m.progress, 'stack'):
+        __m.progress.stack = list()
+    return __m.progress.stack
+
+
+def progress_shown(thru_silent_mode=False):
+    # progress of worker threads is not shown, as it would interleave
+    return not is_silent_mode(thru_silent_mode) and \
+        threading.current_thread() is __m.main_thread
+
+
 def _(text, close=False, thru_silent_mode=False):
-    if is_silent_mode(thru_silent_mode):
+    if not progress_shown(thru_silent_mode):
         return
 
     if info_enabled():
         print('%sINFO: %s' % (' ' if debug_enabled() else '', text))
     else:
-        __m.stack.append(text)  # push
+        progress_stack().append(text)  # push
 
         sys.stdout.write(text)
         sys.stdout.flush()
@@ -84,14 +137,14 @@ def _(text, close=False, thru_silent_mode=False):
 
 
 def __(closing_text=None, thru_silent_mode=False):
-    if is_silent_mode(thru_silent_mode):
+    if not progress_shown(thru_silent_mode):
         return
 
     if closing_text:
         _(closing_text, thru_silent_mode)
 
     if not info_enabled():  # or any lower prio tracing
-        text = __m.stack.pop()  # pop
+        text = progress_stack().pop()  # pop
         backspaces = '\b' * len(text)
         spaces = ' ' * len(text)
 
@@ -107,9 +107,13 @@ class EntityManager:
                     _list.append(item)
         return _list
 
+    @classmethod
+    def sort_list(cls, a_list):
+        return sorted(a_list, key=cls.sort_key)
+
     @staticmethod
-    def sort_list(a_list):
-        return sorted(a_list, key=lambda x: x.name)
+    def sort_key(entity):
+        return entity.name
 
     def list_entity_names(self, filter_f=None, entities=None):
         return self.filtered_list(filter_f, name_only=True, items=entities)
@@ -1,12 +1,17 @@
 from core_out import debug
 from cloud_resource_manager import CloudResourceManager
+from core_cache import CachePolicy
 
 __author__ = 'Kris Sterckx'
 
 
 class FlavorManager(CloudResourceManager):
+    CACHE_TTL = 3600  # secs
+
     def __init__(self, minicloud):
         super(FlavorManager, self).__init__(minicloud)
+        # retrieved flavors in cache remain valid, for long
+        self.set_cache_policy(CachePolicy(self.CACHE_TTL, trusted=True))
         debug("[{}] initialized.", self)
 
     @staticmethod
@@ -20,25 +25,23 @@ class FlavorManager(CloudResourceManager):
     def get_entities(self, ctx, name=None, deep_list=False):
         return ctx.flavors(name)
 
+    def cloud_entity(self, flavor):
+        return flavor.cloud_flavor
+
     def create_entity(self, ctx, flavor):
         pass
 
     def delete_entity(self, ctx, flavor):
         return False
 
-    def trust_cache_when_filled(self):
-        return True   # Retrieved flavor in cache remain valid
-
     # override
     @staticmethod
-    def sort_list(flavors):
-        _list = list()
-        _list.extend([f for f in flavors if 'tiny' in f.name])
-        _list.extend([f for f in flavors if 'small' in f.name])
-        _list.extend([f for f in flavors if 'medium' in f.name])
-        _list.extend([f for f in flavors if 'large' in f.name and
-                      'xlarge' not in f.name])
-        _list.extend([f for f in flavors if 'xlarge' in f.name])
-        # add all the rest
-        _list += [i for i in flavors if i not in _list]
-        return _list
+    def sort_key(flavor):
+        name = flavor.name
+        rank = (0 if 'tiny' in name else
+                1 if 'small' in name else
+                2 if 'medium' in name else
+                3 if 'large' in name and 'xlarge' not in name else
+                4 if 'xlarge' in name else
+                5)  # all the rest
+        return rank, name
@@ -1,12 +1,17 @@
 from cloud_resource_manager import CloudResourceManager
+from core_cache import CachePolicy
 from core_out import debug
 
 __author__ = 'Kris Sterckx'
 
 
 class ImageManager(CloudResourceManager):
+    CACHE_TTL = 3600  # secs
+
     def __init__(self, minicloud):
         super(ImageManager, self).__init__(minicloud)
+        # retrieved images in cache remain valid, for long
+        self.set_cache_policy(CachePolicy(self.CACHE_TTL, trusted=True))
         debug("[{}] initialized.", self)
 
     @staticmethod
@@ -20,25 +25,24 @@ class ImageManager(CloudResourceManager):
     def get_entities(self, ctx, name=None, deep_list=False):
         return ctx.images(name)
 
+    def cloud_entity(self, image):
+        return image.cloud_image
+
     def create_entity(self, ctx, image):
         pass
 
     def delete_entity(self, ctx, image):
         return False
 
-    def trust_cache_when_filled(self):
-        return True   # Retrieved image in cache remain valid
-
     # override
     @staticmethod
-    def sort_list(images):
-        _list = list()
-        _list.extend([i for i in images if 'cirros' in i.name.lower()])
-        _list.extend([i for i in images if 'centos' in i.name.lower()])
-        _list.extend([i for i in images if 'coreos' in i.name.lower()])
-        _list.extend([i for i in images if 'fedora' in i.name.lower()])
-        _list.extend([i for i in images if 'opensuse' in i.name.lower()])
-        _list.extend([i for i in images if 'ubuntu' in i.name.lower()])
-        # add all the rest
-        _list += [i for i in images if i not in _list]
-        return _list
+    def sort_key(image):
+        name = image.name.lower()
+        rank = (0 if 'cirros' in name else
+                1 if 'centos' in name else
+                2 if 'coreos' in name else
+                3 if 'fedora' in name else
+                4 if 'opensuse' in name else
+                5 if 'ubuntu' in name else
+                6)  # all the rest
+        return rank, image.name
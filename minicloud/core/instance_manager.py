@@ -1,6 +1,8 @@
 import time
 
 from cloud_resource_manager import CloudResourceManager
+from core_cache import CachePolicy
+from core_in import shell_variable
 from core_out import assert_equals, debug, end, error, output, trace, warn
 from core_types import IntegrityException, MiniCloudException, \
     InstanceNotReadyYet
@@ -9,8 +11,13 @@ __author__ = 'Kris Sterckx'
 
 
 class InstanceManager(CloudResourceManager):
+    # secs ; opt-in, as once expired, any list() re-lists all clouds
+    CACHE_TTL = int(shell_variable('MINICLOUD_INSTANCE_CACHE_TTL', 0)) or None
+    NAME_TEMPLATE = '{name}-{count}'  # of instances booted in bulk
+
     def __init__(self, minicloud):
         super(InstanceManager, self).__init__(minicloud)
+        self.set_cache_policy(CachePolicy(self.CACHE_TTL))
         self.network_manager = self.minicloud.network_manager
         self.flavor_manager = self.minicloud.flavor_manager
         self.image_manager = self.minicloud.image_manager
@@ -29,9 +36,24 @@ class InstanceManager(CloudResourceManager):
             debug('Instance {} is not ready yet.' % cloud_instance.name)
             return None
 
+    def entity_indexes(self):
+        return dict(ip=lambda instance: instance.ip,
+                    cloud_id=self.cloud_entity_id,
+                    network=lambda instance: instance.network_name)
+
     def get_entities(self, ctx, name=None, deep_list=False):
         return ctx.instances(name)
 
+    def get_changed_entities(self, ctx, since, known_ids):
+        return ctx.changed_instances(since)
+
+    def cloud_entity_id(self, instance):
+        return instance.cloud_instance.id if instance.cloud_instance \
+            else None
+
+    def cloud_entity(self, instance):
+        return instance.cloud_instance
+
     def create_entity(self, ctx, instance):
         ctx.boot(instance)
         self.network_manager.add_instance(instance)
@@ -39,6 +61,49 @@ class InstanceManager(CloudResourceManager):
               instance, instance.network.repr())
         return instance
 
+    def add_many(self, instance, count):
+        # boots count instances alike the given one, in a single request
+        # where the cloud allows ; they are named by NAME_TEMPLATE
+        if count < 2:
+            return [self.add(instance)]
+
+        names = [self.NAME_TEMPLATE.format(name=instance.name, count=c)
+                 for c in range(1, count + 1)]
+        debug('[{}] --- adding {} x {} ---', self, count, instance.repr())
+        for name in names:
+            if self.get(name):
+                error('Name %s already exists.' % name)
+                raise IntegrityException
+
+        try:
+            ctx = self.get_context(instance)
+            if not ctx or not ctx.authenticated():
+                raise IntegrityException
+            instances = ctx.boot_many(instance, names)
+
+        except MiniCloudException as e:
+            error('[{}] Failed to create {} {}s \'{}\'.',
+                  self, count, self.entity_name(), instance.name)
+            raise e
+
+        # the cache is populated from the boot response, not re-listed
+        for booted in instances:
+            booted.set_context(ctx)
+            self.network_manager.add_instance(booted)
+            if self.write_through:
+                self.write_to_cache(booted)
+            else:
+                self.add_to_cache(booted, booted is instances[-1])
+        debug('[{}] booted {} instances in {}.', self,
+              len(instances), instance.network.repr())
+        if len(instances) < count:
+            # the ones booted are kept, and cached
+            error('[{}] Only {} of {} {}s \'{}\' were created.',
+                  self, len(instances), count, self.entity_name(),
+                  instance.name)
+            raise MiniCloudException
+        return instances
+
     def delete_entity(self, ctx, instance):
         self.network_manager.remove_instance(instance)
         ctx.kill(instance)
@@ -100,6 +165,29 @@ class InstanceManager(CloudResourceManager):
                 if instance.network else None
         return instance.network
 
+    def wait_active(self, instances, timeout=None):
+        # waits on the instances together, per cloud ; returns the active
+        # ones
+        building = {}
+        for instance in instances:
+            if not instance.check_status('BUILD', True):
+                building.setdefault(instance.driver_context, []).append(
+                    instance)
+        for ctx, ctx_instances in building.items():
+            ctx.wait_active(ctx_instances, timeout)
+        return [instance for instance in instances if instance.is_active()]
+
+    def wait_ports(self, instances, timeout=None):
+        # waits on the ports of the instances together, per cloud, leaving
+        # them in the port caches
+        devices = {}
+        for instance in instances:
+            ctx = instance.driver_context
+            devices.setdefault(ctx, []).append(
+                ctx.get_instance_device_id(instance))
+        for ctx, device_ids in devices.items():
+            ctx.wait_ports(device_ids, timeout)
+
     def make_routable(self, instance, external_network,
                       ignore_deep_check=False):
         trace('[{}] make_routable ({}, {})', self, instance, external_network)
@@ -172,38 +260,24 @@ class InstanceManager(CloudResourceManager):
         return bool(self.get_instances_by_cluster(cluster_name))
 
     def get_instances_by_cluster(self, cluster_name, deep_list=False):
-        # TODO - optimize
-        instances = list()
-        for instance in self.list(deep_list):
-            if instance.cluster_name == cluster_name:
-                instances.append(instance)
+        instances = self.children(cluster_name, deep_list)  # by parent
         trace('[{}] get_instances_by_cluster: {} instances',
               self, len(instances))
         return instances
 
     def get_instances_by_network(self, network_name, deep_list=False):
-        # TODO - optimize
-        instances = list()
-        for instance in self.list(deep_list):
-            if instance.network_name == network_name:
-                instances.append(instance)
+        instances = self.indexed('network', network_name, deep_list)
         trace('[{}] get_instances_by_network: {} instances',
               self, len(instances))
         return instances
 
     def get_instance_by_ip(self, ip):
         debug('[{}] get_instance_by_ip ({}).', self, ip)
-        # TODO - optimize
-        for instance in self.list():
-            if instance.ip == ip:
-                return instance
-        return None
+        instances = self.indexed('ip', ip) if ip else None
+        return instances[0] if instances else None
 
     def get_instance_by_cloud_instance_id(self, cloud_instance_id):
         trace('[{}] get_instance_by_cloud_instance_id ({}).', self,
               str(cloud_instance_id))
-        # TODO - optimize
-        for instance in self.list():
-            if instance.cloud_instance.id == cloud_instance_id:
-                return instance
-        return None
+        instances = self.indexed('cloud_id', cloud_instance_id)
+        return instances[0] if instances else None
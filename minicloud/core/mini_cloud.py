@@ -1,3 +1,5 @@
+import atexit
+
 from cloud_manager import CloudManager
 from cluster_manager import ClusterManager
 from core_in import shell_variable
@@ -9,7 +11,9 @@ from image_manager import ImageManager
 from instance_manager import InstanceManager
 from network_manager import NetworkManager
 from security_group_manager import SecurityGroupManager
+from snapshot import CacheSnapshot
 from system import System
+from topology import TopologySnapshot
 from router_manager import RouterManager
 
 __author__ = 'Kris Sterckx'
@@ -20,7 +24,10 @@ class MiniCloud:
 
     SLOW_SYSTEM = shell_variable('WINDIR')  # slow on windows
 
-    def __init__(self, db, cluster_support=True):
+    SNAPSHOT = shell_variable('MINICLOUD_SNAPSHOT')
+    SNAPSHOT_MAX_AGE = int(shell_variable('MINICLOUD_SNAPSHOT_MAX_AGE', 300))
+
+    def __init__(self, db, cluster_support=True, use_snapshot=False):
         if db:
             self.db = ('mysql+pymysql://' + db.username + ':' + db.password +
                        '@' + db.host + '/' + db.database)
@@ -44,6 +51,13 @@ class MiniCloud:
 
         self.driver_contexts = {}
         self.cluster_support = cluster_support
+        self.topology_snapshot = TopologySnapshot(self)
+
+        self.snapshot = None
+        if use_snapshot and self.SNAPSHOT:
+            self.snapshot = CacheSnapshot(self.SNAPSHOT, self.SNAPSHOT_MAX_AGE)
+            self.snapshot.load(self.snapshot_managers)
+            atexit.register(self.save_snapshot)
 
         debug("[{}] initialized.\n", self)
 
@@ -83,6 +97,16 @@ class MiniCloud:
         """
         return [self.cloud_manager, self.cluster_manager]
 
+    @property
+    def snapshot_managers(self):
+        """snapshot_managers
+
+        :rtype: list
+        """
+        return [self.flavor_manager, self.image_manager, self.sg_manager,
+                self.network_manager, self.router_manager,
+                self.instance_manager]
+
     @classmethod
     def cloud_manager(cls):
         return cls.the_cloud_manager
@@ -109,6 +133,33 @@ class MiniCloud:
         for m in reversed(self.managers):
             m.reset()
 
+    def snapshot_topology(self, deep=False):
+        # rebuilds the topology caches at once when deep, or when any of
+        # these is to be re-listed anyhow ; returns whether rebuilt
+        if deep or any(not m.is_cache_filled() or m.fill_expired()
+                       for m in self.topology_snapshot.managers):
+            return self.topology_snapshot.build()
+        return False
+
+    def cache_statistics(self):
+        return [(m, m.cache_statistics()) for m in self.managers]
+
+    def driver_cache_statistics(self):
+        return [(cloud, cloud.context().cache_statistics())
+                for cloud in self.cloud_manager.list() if cloud.context()]
+
+    def http_statistics(self):
+        return [(cloud, cloud.context().http_statistics())
+                for cloud in self.cloud_manager.list() if cloud.context()]
+
+    def readiness_statistics(self):
+        return [(cloud, cloud.context().readiness_statistics())
+                for cloud in self.cloud_manager.list() if cloud.context()]
+
+    def save_snapshot(self):
+        if self.snapshot:
+            self.snapshot.save(self.snapshot_managers)
+
     @staticmethod  # keep static, as is registered as function callback
     def never_clear_cache():
         cm = MiniCloud.cloud_manager()
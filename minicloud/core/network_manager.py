@@ -17,9 +17,44 @@ class NetworkManager(CloudResourceManager):
     def entity(self, cloud, ctx, cloud_network):
         return ctx.new_network(cloud, cloud_network)
 
+    def prefetch(self, cloud, ctx, name=None):
+        # all subnets at once, by network id ; a single network fetches its
+        # own subnets
+        if name:
+            return None
+        subnets = {}
+        for cloud_subnet in ctx.subnets():
+            subnets.setdefault(cloud_subnet['network_id'], []).append(
+                cloud_subnet)
+        return subnets
+
+    def new_entity(self, cloud, ctx, cloud_network, subnets=None):
+        if subnets is None:
+            return self.entity(cloud, ctx, cloud_network)
+        return ctx.new_network(cloud, cloud_network,
+                               subnets.get(cloud_network['id'], []))
+
     def get_entities(self, ctx, name=None, deep_list=False):
         return ctx.networks(name)
 
+    def get_changed_entities(self, ctx, since, known_ids):
+        return ctx.changed_networks(since, known_ids)
+
+    def cloud_entity_id(self, network):
+        return self.raw_cloud_id(network.cloud_network)
+
+    def snapshot_entity(self, ctx, network):
+        if network.cloud_network is None:
+            return None
+        return dict(network=ctx.dump_cloud_entity(network.cloud_network),
+                    subnets=[ctx.dump_cloud_entity(cloud_subnet)
+                             for cloud_subnet in network.cloud_subnets or []])
+
+    def restore_entity(self, cloud, ctx, data):
+        return ctx.new_network(cloud, ctx.load_cloud_entity(data['network']),
+                               [ctx.load_cloud_entity(cloud_subnet)
+                                for cloud_subnet in data['subnets']])
+
     def create_entity(self, ctx, network):
         ctx.create_network(network)
         ctx.create_subnets(network)
@@ -145,10 +180,8 @@ class NetworkManager(CloudResourceManager):
 
     def vm_list(self, network):
         if network.vm_list is None:
-            network.vm_list = []
-            for instance in self.minicloud.instance_manager.list():
-                if instance.network_name == network.name:
-                    network.vm_list.append(instance)
+            network.vm_list = self.minicloud.instance_manager.\
+                get_instances_by_network(network.name)
 
         return network.vm_list
 
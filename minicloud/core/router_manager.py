@@ -17,10 +17,39 @@ class RouterManager(CloudResourceManager):
         return ctx.new_router(cloud, cloud_router,
                               self.minicloud.network_manager)
 
+    def prefetch(self, cloud, ctx, name=None):
+        # the networks of the cloud by cloud id, out of the network cache, to
+        # resolve the router gateways from ; a single router only uses them
+        # when cached already
+        network_manager = self.minicloud.network_manager
+        if cloud.is_stubbed():
+            return None  # stub routers have no gateway to resolve
+        elif name and not network_manager.is_cache_filled():
+            return None
+        networks = {}
+        for network in network_manager.list():
+            cloud_id = network_manager.cloud_entity_id(network)
+            if cloud_id and network.cloud.name == cloud.name:
+                networks[cloud_id] = network
+        return networks
+
+    def new_entity(self, cloud, ctx, cloud_router, networks=None):
+        return ctx.new_router(cloud, cloud_router,
+                              self.minicloud.network_manager, networks)
+
     def get_entities(self, ctx, name=None, deep_list=False):
         debug('[{}] get_entities (deep_list={}).', self, deep_list)
         return ctx.routers(name, override_cache=deep_list)
 
+    def get_changed_entities(self, ctx, since, known_ids):
+        return ctx.changed_routers(since, known_ids)
+
+    def cloud_entity_id(self, router):
+        return self.raw_cloud_id(router.cloud_router)
+
+    def cloud_entity(self, router):
+        return router.cloud_router
+
     def create_entity(self, ctx, router):
         ctx.create_router(router)
         return router
@@ -22,6 +22,15 @@ class SecurityGroupManager(CloudResourceManager):
     def get_entities(self, ctx, name=None, deep_list=False):
         return ctx.security_groups(name)
 
+    def get_changed_entities(self, ctx, since, known_ids):
+        return ctx.changed_security_groups(since, known_ids)
+
+    def cloud_entity_id(self, sg):
+        return self.raw_cloud_id(sg.cloud_sg)
+
+    def cloud_entity(self, sg):
+        return sg.cloud_sg
+
     def create_entity(self, ctx, sg):
         sg.cloud_sg = ctx.create_security_group(sg)
         for sg_rule in sg.sg_rules:
@@ -34,11 +43,8 @@ class SecurityGroupManager(CloudResourceManager):
 
     # override
     @staticmethod
-    def sort_list(sgs):
-        _list = list()
-        _list.extend([sg for sg in sgs if 'public_ssh' in sg.name.lower()])
-        _list.extend([sg for sg in sgs if 'public_ssh' not in sg.name.lower()])
-        return _list
+    def sort_key(sg):
+        return 'public_ssh' not in sg.name.lower(), sg.name
 
     def create_ssh_sg_group(self, cloud):
         from minicloud.model.security_group import SecurityGroup
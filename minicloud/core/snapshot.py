@@ -0,0 +1,73 @@
+import json
+import os
+import time
+
+from core_out import debug, info, warn
+from core_utils import write_private_file
+
+__author__ = 'Kris Sterckx'
+
+
+class CacheSnapshot(object):
+    """On-disk snapshot of the cloud resource caches
+
+    Lets a MiniCloud run start off from the caches of the previous run, as
+    long as these are not older than max_age seconds. The snapshot holds the
+    raw cloud entities, per manager, and is written atomically.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, max_age=300):
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+
+    def __repr__(self):
+        return 'Cache snapshot'
+
+    def load(self, managers):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            debug('[{}] no snapshot loaded: {}', self, e)
+            return 0
+
+        if data.get('version') != self.VERSION:
+            info('[{}] ignoring snapshot of other version.', self)
+            return 0
+
+        loaded = 0
+        now = time.time()
+        for manager in managers:
+            cache = data['caches'].get(manager.entity_name())
+            if cache is None:
+                continue
+            elif not 0 <= now - cache['time'] <= self.max_age:
+                info('[{}] {} snapshot is stale.', self, manager)
+            else:
+                manager.preload_cache(cache)
+                loaded += 1
+
+        debug('[{}] {} caches loaded from {}.', self, loaded, self.path)
+        return loaded
+
+    def save(self, managers):
+        caches = {}
+        for manager in managers:
+            if manager.is_cache_filled():
+                cache = manager.snapshot_cache()
+                if cache:
+                    caches[manager.entity_name()] = cache
+
+        try:
+            write_private_file(self.path, json.dumps(
+                dict(version=self.VERSION, caches=caches),
+                separators=(',', ':')))
+
+        except (IOError, OSError) as e:
+            warn('Could not write cache snapshot {}: {}', self.path, e)
+            return False
+
+        debug('[{}] {} caches saved to {}.', self, len(caches), self.path)
+        return True
@@ -0,0 +1,120 @@
+import time
+
+from core_out import debug, info
+from core_utils import parallel_map
+
+__author__ = 'Kris Sterckx'
+
+
+class TopologySnapshot(object):
+    """Builds the topology of all clouds out of a fixed number of listings
+
+    The servers, networks, subnets, ports, routers and floating ips of a
+    cloud are listed once, and joined in memory by id. This fills the
+    network, router and instance caches in one pass, together with the
+    routers of the networks, their vm lists, the router uplinks and the
+    instance fips.
+    """
+
+    def __init__(self, minicloud):
+        self.minicloud = minicloud
+
+    def __repr__(self):
+        return 'Topology snapshot'
+
+    @property
+    def managers(self):
+        return [self.minicloud.network_manager, self.minicloud.router_manager,
+                self.minicloud.instance_manager]
+
+    def build(self):
+        # returns whether built ; not so when any cloud can't list its
+        # topology resources at once
+        contexts = []
+        for cloud in self.minicloud.cloud_manager.list():
+            ctx = cloud.context()
+            if cloud.is_stubbed() or not ctx or not ctx.authenticated():
+                return False
+            contexts.append((cloud, ctx))
+        if not contexts:
+            return False
+
+        sync_stamp = time.time()
+        resources = parallel_map(
+            lambda cloud_ctx: cloud_ctx[1].topology_resources(), contexts,
+            self.minicloud.network_manager.MAX_CLOUD_WORKERS)
+        if None in resources:
+            debug('[{}] not supported by all clouds.', self)
+            return False
+
+        networks, routers, instances = [], [], []
+        for (cloud, ctx), cloud_resources in zip(contexts, resources):
+            cloud_networks, cloud_routers, cloud_instances = self.join(
+                cloud, ctx, cloud_resources)
+            networks.extend(cloud_networks)
+            routers.extend(cloud_routers)
+            instances.extend(cloud_instances)
+
+        for manager, entities in zip(self.managers,
+                                     (networks, routers, instances)):
+            manager.replace_cache(entities)
+            for cloud, _ in contexts:
+                manager.sync_stamps[cloud.name] = sync_stamp
+
+        info('[{}] {} networks, {} routers and {} instances in {:.2f}s.',
+             self, len(networks), len(routers), len(instances),
+             time.time() - sync_stamp)
+        return True
+
+    def join(self, cloud, ctx, resources):
+        network_manager = self.minicloud.network_manager
+        instance_manager = self.minicloud.instance_manager
+
+        subnets = {}  # network id -> its subnets
+        for cloud_subnet in resources['subnets']:
+            subnets.setdefault(cloud_subnet['network_id'], []).append(
+                cloud_subnet)
+
+        networks = {}  # cloud id -> network
+        for cloud_network in resources['networks']:
+            network = ctx.new_network(cloud, cloud_network,
+                                      subnets.get(cloud_network['id'], []))
+            network.set_router(None)  # no routers, unless found below
+            network.vm_list = []
+            networks[cloud_network['id']] = network
+
+        routers = {}  # cloud id -> router
+        for cloud_router in resources['routers']:
+            router = ctx.new_router(cloud, cloud_router, network_manager,
+                                    networks)
+            if router.ext_network:
+                router.ext_network.set_router(router)  # the uplink
+            routers[cloud_router['id']] = router
+
+        ports = {}  # device id -> its ports
+        for port in resources['ports']:
+            ports.setdefault(port['device_id'], []).append(port)
+            router = routers.get(port['device_id'])
+            network = networks.get(port['network_id'])
+            if router and network and not network.external:
+                network.set_router(router)  # a router interface
+
+        fips = dict((fip['port_id'], fip['floating_ip_address'])
+                    for fip in resources['floatingips'] if fip['port_id'])
+
+        by_name = dict((network.name, network)
+                       for network in networks.values())
+        instances = []
+        for server in resources['servers']:
+            instance = instance_manager.entity(cloud, ctx, server)
+            if instance is None:
+                continue
+            instance.set_fip(next((fips[port['id']]
+                                   for port in ports.get(server.id, ())
+                                   if port['id'] in fips), None))
+            network = by_name.get(instance.network_name)
+            if network:
+                network.vm_list.append(instance)
+            instances.append(instance)
+
+        return list(networks.values()), list(routers.values()), instances
@@ -1,3 +1,5 @@
+import time
+
 from abc import ABCMeta, abstractmethod
 
 from minicloud.core.core_utils import _, __
@@ -28,21 +30,68 @@ class DriverContext:
             return True, None
 
     @abstractmethod
-    def new_network(self, cloud, cloud_network):
+    def new_network(self, cloud, cloud_network, cloud_subnets=None):
         pass
 
     @abstractmethod
-    def new_router(self, cloud, cloud_router, net_manager):
+    def new_router(self, cloud, cloud_router, net_manager, networks=None):
+        # networks, when given, maps cloud network ids onto known networks
         pass
 
+    def topology_resources(self):
+        # the servers, networks, subnets, ports, routers and floating ips,
+        # by one listing each ; None when not supported
+        return None
+
     @abstractmethod
     def new_instance(self, cloud, cloud_instance):
         pass
 
+    @staticmethod
+    def dump_cloud_entity(cloud_entity):
+        # compact and serializable form of a cloud entity
+        if hasattr(cloud_entity, 'to_dict'):
+            return cloud_entity.to_dict()
+        else:
+            return dict(cloud_entity)
+
+    @staticmethod
+    def load_cloud_entity(data):
+        return CloudObject(data)
+
+    def compact_instance(self, cloud_instance):
+        return cloud_instance
+
     def reread_instance(self, instance):
-        instance.cloud_instance = self.instances(instance.name)[0]
+        instance.cloud_instance = self.compact_instance(
+            self.instances(instance.name)[0])
         self.set_instance_runtime_data(instance)
 
+    def wait_active(self, instances, timeout=None):
+        # waits on the instances to get out of BUILD, re-reading each of them
+        # every second by default ; returns whether none timed out
+        deadline = time.time() + timeout if timeout is not None else None
+        for instance in instances:
+            while not instance.check_status('BUILD', True, True):
+                if deadline is not None and time.time() > deadline:
+                    return False
+                time.sleep(1)
+        return True
+
+    def wait_ports(self, device_ids, timeout=None):
+        # waits on the devices to have ports ; returns them by device id
+        return dict((device_id, self.ports(device_id=device_id))
+                    for device_id in device_ids)
+
+    def cache_statistics(self):
+        return {}
+
+    def http_statistics(self):
+        return {}
+
+    def readiness_statistics(self):
+        return {}
+
     @abstractmethod
     def set_instance_runtime_data(self, instance):
         pass
@@ -67,6 +116,11 @@ class DriverContext:
     def security_groups(self, name=None):
         pass
 
+    def changed_security_groups(self, since, known_ids):
+        # returns the sg's changed since given time, and the ids out of
+        # known_ids which are deleted ; None when not supported
+        return None
+
     @abstractmethod
     def create_security_group(self, sg):
         pass
@@ -91,10 +145,25 @@ class DriverContext:
     def instances(self, name=None):
         pass
 
+    def changed_instances(self, since):
+        # returns the instances changed since given time, and the ids of
+        # the deleted ones ; None when not supported
+        return None
+
     @abstractmethod
     def boot(self, instance):
         pass
 
+    def boot_many(self, instance, names):
+        # boots instances alike the given one, under given names, returning
+        # them ; one by one by default
+        instances = []
+        for name in names:
+            clone = instance.clone(name)
+            self.boot(clone)
+            instances.append(clone)
+        return instances
+
     @abstractmethod
     def kill(self, instance):
         pass
@@ -103,6 +172,11 @@ class DriverContext:
     def routers(self, name=None, info=None, override_cache=False):
         pass
 
+    def changed_routers(self, since, known_ids):
+        # returns the routers changed since given time, and the ids out of
+        # known_ids which are deleted ; None when not supported
+        return None
+
     def create_router(self, router):
         _('... Creating router')
         router.cloud_router = self.new_cloud_router(router)
@@ -129,6 +203,11 @@ class DriverContext:
     def networks(self, name=None):
         pass
 
+    def changed_networks(self, since, known_ids):
+        # returns the networks changed since given time, and the ids out of
+        # known_ids which are deleted ; None when not supported
+        return None
+
     @abstractmethod
     def subnets(self, cloud_network=None):
         pass
@@ -203,6 +282,19 @@ class DriverContext:
         pass
 
 
+class CloudObject(dict):
+    """Cloud entity as restored from its dumped form
+
+    Gives attribute access as well as dict access to its data.
+    """
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+
 class NetworkIp:
     def __init__(self, net_name, ip):
         self.net_name = net_name
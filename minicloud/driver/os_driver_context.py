@@ -1,3 +1,4 @@
+import threading
 import time
 
 from minicloud.model.network import Network
@@ -7,21 +8,108 @@ from minicloud.model.instance import Instance
 from minicloud.model.cluster import Cluster
 from minicloud.model.security_group import SecurityGroup
 
-from minicloud.core.core_utils import _, __
-from minicloud.core.core_out import error, debug, exc_error, trace
+from minicloud.core.core_cache import CacheBudget, LruCache
+from minicloud.core.core_in import shell_variable
+from minicloud.core.core_utils import _, __, parallel_map
+from minicloud.core.core_out import error, debug, exc_error, trace, warn
 from minicloud.core.core_types import IntegrityException, InstanceNotReadyYet
 
-from driver_context import DriverContext, NetworkIp
+from driver_context import CloudObject, DriverContext, NetworkIp
+from readiness import InstanceWaiter, PortWaiter
 
 __author__ = 'Kris Sterckx'
 
 
+class FloatingIpTable(object):
+    """The floating ips of a cloud, indexed by port id
+
+    Loaded by a single listing and kept up to date on allocation,
+    association and deallocation ; reloaded once older than ttl seconds.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.fips = None  # fip id -> fip ; None when not loaded
+        self.by_port = {}  # port id -> fip id
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.fips) if self.fips else 0
+
+    def loaded(self):
+        return self.fips is not None and (
+            self.ttl is None or time.time() - self.loaded_at < self.ttl)
+
+    def load(self, fips):
+        with self.lock:
+            self.fips, self.by_port = {}, {}
+            self.loaded_at = time.time()
+            for fip in fips:
+                self._put(fip)
+
+    def put(self, fip):
+        with self.lock:
+            if self.fips is not None:
+                self._put(fip)
+
+    def _put(self, fip):
+        self._remove(fip['id'])
+        self.fips[fip['id']] = fip
+        if fip['port_id']:
+            self.by_port[fip['port_id']] = fip['id']
+
+    def remove(self, fip_id):
+        with self.lock:
+            if self.fips is not None:
+                self._remove(fip_id)
+
+    def _remove(self, fip_id):
+        fip = self.fips.pop(fip_id, None)
+        if fip and self.by_port.get(fip['port_id']) == fip_id:
+            del self.by_port[fip['port_id']]
+
+    def all(self):
+        with self.lock:
+            return list(self.fips.values()) if self.fips else []
+
+    def port_fip(self, port_id):
+        with self.lock:
+            return self.fips[self.by_port[port_id]] \
+                if port_id in self.by_port else None
+
+
 class OSDriverContext(DriverContext):
+    SYNC_SKEW = 60  # secs, allowing for clock skew with the cloud
+
+    PORTS_CACHE_SIZE = int(shell_variable('MINICLOUD_PORTS_CACHE_SIZE', 512))
+    ROUTERS_CACHE_SIZE = int(
+        shell_variable('MINICLOUD_ROUTERS_CACHE_SIZE', 256))
+    CACHE_MAX_BYTES = int(  # per cloud ; 0 is unbounded
+        shell_variable('MINICLOUD_CACHE_MAX_BYTES', 0))
+    PORT_DELETE_WORKERS = int(
+        shell_variable('MINICLOUD_PORT_DELETE_WORKERS', 16))
+    PORT_WAIT_DEADLINE = int(  # secs
+        shell_variable('MINICLOUD_PORT_WAIT_DEADLINE', 120))
+    FIP_TABLE_TTL = int(  # secs
+        shell_variable('MINICLOUD_FIP_TABLE_TTL', 60))
+
+    # the server fields which instances make use of
+    INSTANCE_FIELDS = ('id', 'name', 'status', 'flavor', 'image',
+                       'security_groups', 'metadata', 'addresses')
+
     def __init__(self, os_client):
         super(OSDriverContext, self).__init__()
         self.os_client = os_client
-        self.routers_cache = {}
-        self.ports_cache = {}
+        budget = CacheBudget(self.CACHE_MAX_BYTES) \
+            if self.CACHE_MAX_BYTES else None
+        self.routers_cache = LruCache(self.ROUTERS_CACHE_SIZE, budget)
+        self.routers_listed = None  # cache evictions, once all are listed
+        self.ports_cache = LruCache(self.PORTS_CACHE_SIZE, budget)
+        self.cache_lock = threading.RLock()  # guards both caches
+        self.instance_waiter = InstanceWaiter(self)
+        self.port_waiter = PortWaiter(self)
+        self.fip_table = FloatingIpTable(self.FIP_TABLE_TTL)
 
     def __repr__(self):
         return 'OS driver ctx'
@@ -48,22 +136,83 @@ class OSDriverContext(DriverContext):
     ###
 
     def get_ports_by_device_id(self, device_id, override_cache=False):
-        if override_cache or device_id not in self.ports_cache:
+        with self.cache_lock:
+            ports = None if override_cache else \
+                self.ports_cache.get(device_id)
+        if ports is None:
             _('... Retrieving device ports from device ' + device_id[:6])
             ports = self._neutron.ports(device_id=device_id)
             __()
 
             self.fill_port_cache(device_id, ports)
-            return ports
-        else:
-            return self.ports_cache[device_id]
+        return ports
+
+    def poll_ports(self, device_ids):
+        return self._neutron.ports(device_id=device_ids)
+
+    def wait_ports(self, device_ids, timeout=None):
+        # waits on the devices to have ports, all polled together ; returns
+        # the ports by device id, of the devices which got them in time
+        waiting = []
+        ports = {}
+        for device_id in device_ids:
+            device_ports = self.get_ports_by_device_id(device_id)
+            if device_ports:
+                ports[device_id] = device_ports
+            else:
+                waiting.append(device_id)
+        if waiting:
+            debug('[{}] waiting on ports of {} devices.', self, len(waiting))
+            ports.update(self.port_waiter.wait_ports(
+                waiting, self.PORT_WAIT_DEADLINE if timeout is None
+                else timeout))
+        return ports
 
     def fill_port_cache(self, device_id, ports):
-        self.ports_cache[device_id] = ports
+        with self.cache_lock:
+            self.ports_cache[device_id] = ports
 
     def clear_port_cache(self, device_id):
-        if device_id in self.ports_cache:
-            del self.ports_cache[device_id]
+        with self.cache_lock:
+            self.ports_cache.pop(device_id, None)
+
+    def sync_port_cache(self, since):
+        if self.ports_cache:
+            delta = self._neutron.changed('ports', self.changes_since(since),
+                                          with_ids=False)
+            with self.cache_lock:
+                if delta is None:
+                    self.ports_cache.clear()
+                else:
+                    for port in delta[0]:
+                        self.clear_port_cache(port['device_id'])
+
+    ###
+
+    def cache_statistics(self):
+        with self.cache_lock:
+            return dict(ports=self.ports_cache.stats(),
+                        routers=self.routers_cache.stats())
+
+    def http_statistics(self):
+        return self.os_client.http_statistics()
+
+    def readiness_statistics(self):
+        return dict(instances=self.instance_waiter.stats(),
+                    ports=self.port_waiter.stats())
+
+    def changes_since(self, since):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                             time.gmtime(since - self.SYNC_SKEW))
+
+    def changed_neutron_resources(self, collection, since, known_ids):
+        _('... Retrieving changed ' + collection.replace('_', ' '))
+        delta = self._neutron.changed(collection, self.changes_since(since))
+        __()
+        if delta is None:
+            return None
+        changed, ids = delta
+        return changed, known_ids - ids
 
     ###
 
@@ -106,6 +255,7 @@ class OSDriverContext(DriverContext):
     ###
 
     def new_instance(self, cloud, cloud_instance):
+        cloud_instance = self.compact_instance(cloud_instance)
         cluster_name = self.get_instance_cluster_name(cloud, cloud_instance)
         try:
             instance = Instance(
@@ -138,6 +288,14 @@ class OSDriverContext(DriverContext):
         else:
             return Cluster.unnamed_cluster_name(cloud.name)
 
+    def compact_instance(self, cloud_instance):
+        # drop the (full) server object, keeping the fields in use only
+        if isinstance(cloud_instance, CloudObject):
+            return cloud_instance
+        info = cloud_instance.to_dict()
+        return CloudObject((field, info[field])
+                           for field in self.INSTANCE_FIELDS if field in info)
+
     def get_instance_device_id(self, instance):
         return instance.cloud_instance.id
 
@@ -147,6 +305,37 @@ class OSDriverContext(DriverContext):
         __()
         return instances
 
+    def changed_instances(self, since):
+        _('... Retrieving changed instances')
+        servers = self._nova.changed_servers(self.changes_since(since))
+        __()
+        if servers is None:
+            return None
+
+        changed, deleted_ids = [], set()
+        for server in servers:
+            if server.status in ('DELETED', 'SOFT_DELETED'):
+                deleted_ids.add(server.id)
+                self.clear_port_cache(server.id)
+            else:
+                changed.append(server)
+
+        # ports of changed devices are to be re-read
+        self.sync_port_cache(since)
+        return changed, deleted_ids
+
+    def poll_instances(self, since=None):
+        # the servers changed since given time, or all servers
+        if since is not None:
+            servers = self._nova.changed_servers(self.changes_since(since))
+            if servers is not None:
+                return servers
+        return self._nova.servers()
+
+    def wait_active(self, instances, timeout=None):
+        # all instances are polled together, by one listing per tick
+        return self.instance_waiter.wait_instances(instances, timeout)
+
     def boot(self, instance):
         sg_names = [instance.cloud_sg['name']] if instance.cloud_sg else []
 
@@ -161,6 +350,35 @@ class OSDriverContext(DriverContext):
 
         self.set_instance_runtime_data(instance)
 
+    def boot_many(self, instance, names):
+        # a single multi-create request ; nova names the servers, by its
+        # multi_instance_display_name_template, which defaults to the
+        # '{name}-{count}' names passed in
+        if len(names) < 2:
+            return super(OSDriverContext, self).boot_many(instance, names)
+
+        sg_names = [instance.cloud_sg['name']] if instance.cloud_sg else []
+
+        _('... Booting instances')
+        servers = self._nova.boot_many(
+            instance.name, len(names),
+            instance.cloud_image, instance.cloud_flavor, sg_names,
+            instance.cloud_network['id'],
+            {'cluster': instance.cluster_name} if instance.cluster_name
+            else None)
+        __()
+        if len(servers) < len(names):
+            warn('[{}] {} of {} instances found booted.', self,
+                 len(servers), len(names))
+
+        instances = []
+        for server in servers:
+            booted = instance.clone(server.name)
+            booted.cloud_instance = self.compact_instance(server)
+            self.set_instance_runtime_data(booted)
+            instances.append(booted)
+        return instances
+
     def set_instance_runtime_data(self, instance):
         net_ip = self._get_networks_ip(instance.cloud_instance)
         instance.ip = net_ip[0].ip if net_ip \
@@ -185,64 +403,139 @@ class OSDriverContext(DriverContext):
 
     ###
 
-    def new_router(self, cloud, cloud_router, net_manager):
+    def new_router(self, cloud, cloud_router, net_manager, networks=None):
         cloud_net_id = cloud_router['external_gateway_info']['network_id'] \
             if cloud_router['external_gateway_info'] else None
-        cloud_net = self._neutron.networks(net_id=cloud_net_id)[0] \
-            if cloud_net_id else None
-        cloud_net_name = cloud_net['name'] if cloud_net else None
-        network = net_manager.get(cloud_net_name) if cloud_net_name else None
+        network = networks.get(cloud_net_id) \
+            if cloud_net_id and networks is not None else None
+        if cloud_net_id and network is None:
+            # not known (yet), so looked up
+            cloud_net = self._neutron.networks(net_id=cloud_net_id)[0]
+            cloud_net_name = cloud_net['name'] if cloud_net else None
+            network = net_manager.get(cloud_net_name) \
+                if cloud_net_name else None
         return Router(cloud_router['name'],
                       cloud,
                       cloud_router,
                       network,
                       self)
 
-    def routers(self, name=None, info=None, override_cache=False):
-        if self.routers_cache is None or override_cache:
-            _('... Retrieving router' +
-              ((' ' + name) if name else
-               (('s (' + info + ')') if info else 's')))
-            self.routers_cache = {}
-            for cloud_router in self._neutron.routers():
+    def topology_resources(self):
+        # listed concurrently ; the router and port caches are refreshed on
+        # the way
+        _('... Retrieving topology')
+        servers, networks, subnets, ports, routers, fips = parallel_map(
+            lambda list_f: list_f(),
+            (self._nova.servers,
+             lambda: list(self._neutron.iter_networks()),
+             self._neutron.subnets,
+             self._neutron.ports,
+             lambda: list(self._neutron.iter_routers()),
+             self._neutron.floating_ips))
+        __()
+
+        device_ports = {}
+        for port in ports:
+            device_ports.setdefault(port['device_id'], []).append(port)
+        with self.cache_lock:
+            self.routers_cache.clear()
+            evictions = self.routers_cache.evictions
+            for cloud_router in routers:
                 self.routers_cache[cloud_router['id']] = cloud_router
-            __()
-            return self.routers_cache.values()
+            self.routers_listed = evictions \
+                if self.routers_cache.evictions == evictions else None
+            for device_id, d_ports in device_ports.items():
+                if device_id:
+                    self.ports_cache[device_id] = d_ports
+
+        self.fip_table.load(fips)
+
+        return dict(servers=servers, networks=networks, subnets=subnets,
+                    ports=ports, routers=routers, floatingips=fips)
+
+    def routers(self, name=None, info=None, override_cache=False):
+        # served by the cache when holding all routers, else yielded as
+        # their page arrives
+        cached = None if override_cache else self.cached_routers()
+        if cached is not None:
+            return [cloud_router for cloud_router in cached
+                    if not name or cloud_router['name'] == name]
         elif name:
-            return self._neutron.routers(name)
+            return self._neutron.iter_routers(name)
         else:
-            return self._neutron.routers()
+            return self.list_routers(info)
+
+    def cached_routers(self):
+        # all routers, when fully listed and none were evicted since
+        with self.cache_lock:
+            if self.routers_listed is not None and \
+                    self.routers_listed == self.routers_cache.evictions:
+                return self.routers_cache.values()
+            return None
+
+    def list_routers(self, info=None):
+        _('... Retrieving routers' + ((' (' + info + ')') if info else ''))
+        try:
+            with self.cache_lock:
+                self.routers_cache.clear()
+                self.routers_listed = None
+                evictions = self.routers_cache.evictions
+            for cloud_router in self._neutron.iter_routers():
+                self.cache_router(cloud_router)
+                yield cloud_router
+            with self.cache_lock:
+                if self.routers_cache.evictions == evictions:
+                    self.routers_listed = evictions
+        finally:
+            __()
+
+    def changed_routers(self, since, known_ids):
+        delta = self.changed_neutron_resources('routers', since, known_ids)
+        if delta is not None:
+            changed, deleted_ids = delta
+            with self.cache_lock:
+                for cloud_router in changed:
+                    self.routers_cache[cloud_router['id']] = cloud_router
+                for router_id in deleted_ids:
+                    self.routers_cache.pop(router_id, None)
+        return delta
 
     def new_cloud_router(self, router):
         cloud_router = self._neutron.create_router(
             router.name, router.ext_network.cloud_network['id']
             if router.ext_network else None)
-        self.routers_cache[cloud_router['id']] = cloud_router
+        self.cache_router(cloud_router)
         return cloud_router
 
+    def cache_router(self, cloud_router):
+        with self.cache_lock:
+            self.routers_cache[cloud_router['id']] = cloud_router
+
     def uplink_router(self, router, ext_network):
         _('... Uplinking router')
         self._neutron.uplink_router(router.cloud_router['id'],
                                     ext_network.cloud_network['id'])
-        self.routers_cache[router.cloud_router['id']] = router.cloud_router
+        self.cache_router(router.cloud_router)
         __()
 
     def unlink_router(self, router):
         _('... Unlinking router')
         self._neutron.unlink_router(router.cloud_router['id'])
-        self.routers_cache[router.cloud_router['id']] = router.cloud_router
+        self.cache_router(router.cloud_router)
         __()
 
     def delete_router(self, router):
-        if self.routers_cache:
-            del self.routers_cache[router.cloud_router['id']]
+        with self.cache_lock:
+            if self.routers_cache:
+                self.routers_cache.pop(router.cloud_router['id'], None)
         self._neutron.delete_router(router.cloud_router['id'])
         debug('[{}] {} deleted.', self, str(router))
 
     ###
 
-    def new_network(self, cloud, cloud_network):
-        cloud_subnets = self.subnets(cloud_network)
+    def new_network(self, cloud, cloud_network, cloud_subnets=None):
+        if cloud_subnets is None:
+            cloud_subnets = self.subnets(cloud_network)
         external = cloud_network['router:external']
         router = None  # leave lazy
         return Network(cloud_network['name'],
@@ -251,16 +544,23 @@ class OSDriverContext(DriverContext):
                        cloud_subnets=cloud_subnets, driver_context=self)
 
     def networks(self, name=None):
+        # yields the networks as their page arrives
         _('... Retrieving network' + ((' ' + name) if name else 's'))
-        networks = self._neutron.networks(name)
-        __()
-        return networks
+        try:
+            for cloud_network in self._neutron.iter_networks(name):
+                yield cloud_network
+        finally:
+            __()  # also when not consumed to the end
+
+    def changed_networks(self, since, known_ids):
+        return self.changed_neutron_resources('networks', since, known_ids)
 
     def subnets(self, cloud_network=None):
         _('... Retrieving subnet' +
           ((' for network ' + cloud_network['name']) if cloud_network
            else 's'))
-        subnets = self._neutron.subnets(cloud_network['id'])
+        subnets = self._neutron.subnets(
+            cloud_network['id'] if cloud_network else None)
         __()
         return subnets
 
@@ -268,9 +568,8 @@ class OSDriverContext(DriverContext):
         return self._neutron.create_network(network.name, network.external)
 
     def new_cloud_subnets(self, network):
-        for cidr in network.cidrs:
-            return self._neutron.create_subnet(network.cloud_network['id'],
-                                               cidr)
+        return [self._neutron.create_subnet(network.cloud_network['id'], cidr)
+                for cidr in network.cidrs]
 
     def find_attached_routers(self, network):
         routers = list()
@@ -388,12 +687,22 @@ class OSDriverContext(DriverContext):
                      compute_only=False,
                      standalone_only=False):
         trace('[{}] delete_ports [{}]', self, network['name'])
-        for port in self.ports(network,
-                               compute_only=compute_only,
-                               standalone_only=standalone_only,
-                               no_dhcp=True):
-            self._neutron.delete_port(port['id'])
-            debug('[{}] Port [{}] deleted', self, port['id'])
+        port_ids = [port['id'] for port in self.ports(
+            network, compute_only=compute_only,
+            standalone_only=standalone_only, no_dhcp=True)]
+        if not port_ids:
+            return
+
+        _('... Deleting ports')
+        failures = self._neutron.delete_ports(port_ids,
+                                              self.PORT_DELETE_WORKERS)
+        __()
+
+        for port_id, e in failures:
+            error('[{}] Port [{}] could not be deleted: {}', self, port_id, e)
+        debug('[{}] {} ports deleted', self, len(port_ids) - len(failures))
+        if failures:
+            raise failures[0][1]
 
     @staticmethod
     def filter_ports_by_network(ports, network_id):
@@ -430,32 +739,31 @@ class OSDriverContext(DriverContext):
         return PublicIp(name, network_id, ip, fixed_ip, port_id,
                         cloud, cloud_floating_ip, self)
 
+    def loaded_fip_table(self):
+        if not self.fip_table.loaded():
+            _('... Retrieving public ips')
+            self.fip_table.load(self._neutron.floating_ips())
+            __()
+        return self.fip_table
+
     def get_floating_ip(self, instance):
-        fip = self.floating_ips(instance)
-        if fip:
-            return fip[0]['floating_ip_address']
-        else:
-            return None
+        # by the ports of the instance, fetched when not cached ; not by its
+        # fixed ips, as tenant networks may overlap
+        table = self.loaded_fip_table()
+        fips = list(filter(None, (table.port_fip(port['id']) for port in
+                                  self.get_ports_by_device_id(instance.id))))
+        return fips[0]['floating_ip_address'] if fips else None
 
     def floating_ips(self, instance=None, network=None):
+        table = self.loaded_fip_table()
         if instance:
-            override_cache = False
-            while True:
-                ports = self.ports(device_id=instance.id,
-                                   override_cache=override_cache)
-                if ports:
-                    break
-                else:
-                    debug('{} has no ports, refreshing in sec.', instance.name)
-
-                    override_cache = True
-                    time.sleep(1)
+            ports = self.wait_ports([instance.id]).get(instance.id)
+            if not ports:
+                error('[{}] {} has no ports.', self, instance.name)
+                return []
 
-            _('... Retrieving public ips')
-            fips = self._neutron.floating_ips(
-                # TODO - fix, take first port for now
-                ports[0]['fixed_ips'][0]['ip_address'])
-            __()
+            fips = list(filter(None, (table.port_fip(port['id'])
+                                      for port in ports)))
             if fips:
                 debug('[{}] instance {} has public ip {}.', self,
                       instance.name, fips[0])
@@ -464,28 +772,28 @@ class OSDriverContext(DriverContext):
                       instance.name)
         else:
             # TODO same for network
-
-            _('... Retrieving public ips')
-            fips = self._neutron.floating_ips()
-            __()
+            fips = table.all()
 
         return fips
 
     def allocate_floating_ip(self, network, port=None):
         _('... Allocating public ip')
         fip = self._neutron.allocate_floating_ip(
-            network['id'], port['id'])['floating_ip_address']
+            network['id'], port['id'])
+        self.fip_table.put(fip)
         __()
-        return fip
+        return fip['floating_ip_address']
 
     def associate_floating_ip(self, fip, port=None):
         _('... Associating public ip')
-        self._neutron.associate_floating_ip(fip, port['id'])
+        self.fip_table.put(self._neutron.associate_floating_ip(
+            fip, port['id'])['floatingip'])
         __()
 
     def deallocate_floating_ip(self, fip):
         _('... Deallocating public ip')
         self._neutron.deallocate_floating_ip(fip)
+        self.fip_table.remove(fip['id'])
         __()
         debug('[{}] {} deallocated.', self, str(fip))
 
@@ -496,10 +804,17 @@ class OSDriverContext(DriverContext):
                              cloud, cloud_sg, self)
 
     def security_groups(self, name=None):
+        # yields the sg's as their page arrives
         _('... Retrieving neutron sg\'s')
-        sgs = self._neutron.security_groups(name=name)
-        __()
-        return sgs
+        try:
+            for cloud_sg in self._neutron.iter_security_groups(name):
+                yield cloud_sg
+        finally:
+            __()  # also when not consumed to the end
+
+    def changed_security_groups(self, since, known_ids):
+        return self.changed_neutron_resources('security_groups', since,
+                                              known_ids)
 
     def create_security_group(self, sg):
         _('... Creating neutron sg')
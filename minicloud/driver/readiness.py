@@ -0,0 +1,236 @@
+import threading
+import time
+
+from minicloud.core.core_out import debug, exc_error, trace
+
+__author__ = 'Kris Sterckx'
+
+
+class Readiness(object):
+    """Outcome of waiting on one resource, resolved by a Waiter
+
+    Callers may block on it by wait(), or be called back on resolution. A
+    resource not ready by its deadline is resolved with a None result.
+    """
+
+    def __init__(self, key, callback=None, deadline=None):
+        self.key = key
+        self.callbacks = [callback] if callback else []
+        self.since = time.time()
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.result = None
+        self.elapsed = None
+
+    def extend(self, deadline):
+        if self.deadline is not None:
+            self.deadline = None if deadline is None \
+                else max(self.deadline, deadline)
+
+    def expired(self, now):
+        return self.deadline is not None and now > self.deadline
+
+    def resolve(self, result):
+        self.result = result
+        self.elapsed = time.time() - self.since
+        for callback in self.callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                exc_error('[{}] callback failed: {}', self.key, e)
+        self.done.set()  # only once called back
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.done.is_set()
+
+
+class Waiter(object):
+    """Waits on a set of pending resources, polling them all at once
+
+    A single poll per tick covers all pending resources; the poll interval
+    grows by backoff while nothing resolves, and drops back to its minimum
+    when something does. The polling runs on a daemon thread, which lives
+    as long as anything is pending.
+    """
+
+    MIN_INTERVAL = 1  # secs
+    MAX_INTERVAL = 10
+    BACKOFF = 1.5
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.pending = {}  # key -> Readiness
+        self.fresh = False  # whether keys were added since the last poll
+        self.thread = None
+        self.polls = 0
+        self.resolved = 0
+        self.expired = 0
+        self.ready_time = 0.0  # summed over the resolved resources
+        self.max_ready_time = 0.0
+
+    def __repr__(self):
+        return self.name
+
+    def watch(self, key, callback=None, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            readiness = self.pending.get(key)
+            if readiness is None:
+                readiness = self.pending[key] = Readiness(key, callback,
+                                                          deadline)
+                self.fresh = True
+            else:
+                readiness.extend(deadline)
+                if callback:
+                    readiness.callbacks.append(callback)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name=self.name)
+                self.thread.daemon = True
+                self.thread.start()
+        return readiness
+
+    def wait(self, keys, timeout=None):
+        # waits on all keys, at most timeout secs ; returns their readiness
+        return self.wait_all([self.watch(key, timeout=timeout)
+                              for key in keys], timeout)
+
+    @staticmethod
+    def wait_all(waited, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        for readiness in waited:
+            readiness.wait(max(0, deadline - time.time())
+                           if deadline is not None else None)
+        return waited
+
+    def run(self):
+        interval = self.MIN_INTERVAL
+        since = None
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                keys = set(self.pending)
+                full_poll = self.fresh or since is None
+                self.fresh = False
+
+            tick = time.time()
+            try:
+                results = self.poll(keys, None if full_poll else since)
+                since = tick
+            except Exception as e:
+                exc_error('[{}] poll failed: {}', self, e)
+                results = {}
+                since = None  # as fresh keys may have been missed
+            self.polls += 1
+
+            resolved, expired = [], []
+            now = time.time()
+            with self.lock:
+                for key, result in results.items():
+                    readiness = self.pending.pop(key, None)
+                    if readiness is not None:
+                        resolved.append(readiness)
+                for key, readiness in list(self.pending.items()):
+                    if readiness.expired(now):
+                        expired.append(self.pending.pop(key))
+            for readiness in resolved:
+                readiness.resolve(results[readiness.key])
+                self.count_ready(readiness.elapsed)
+                trace('[{}] {} ready in {}s.', self,
+                      readiness.key, round(readiness.elapsed, 1))
+            for readiness in expired:
+                readiness.resolve(None)
+                self.expired += 1
+                debug('[{}] {} not ready within {}s.', self,
+                      readiness.key, round(readiness.elapsed))
+
+            interval = self.MIN_INTERVAL if resolved \
+                else min(interval * self.BACKOFF, self.MAX_INTERVAL)
+            time.sleep(interval)
+
+    def poll(self, keys, since):
+        # returns the results of the keys which are ready, by key ; since is
+        # the time of the previous poll, or None when a full poll is needed
+        raise NotImplementedError
+
+    def count_ready(self, elapsed):
+        self.resolved += 1
+        self.ready_time += elapsed
+        self.max_ready_time = max(self.max_ready_time, elapsed)
+
+    def stats(self):
+        return dict(polls=self.polls, pending=len(self.pending),
+                    resolved=self.resolved, expired=self.expired,
+                    mean_ready_time=self.ready_time / self.resolved
+                    if self.resolved else None,
+                    max_ready_time=self.max_ready_time)
+
+
+class InstanceWaiter(Waiter):
+    """Waits on booting instances, until out of BUILD
+
+    Each tick lists the servers changed since the previous one, or all
+    servers when new instances were added to the wait.
+    """
+
+    def __init__(self, ctx):
+        super(InstanceWaiter, self).__init__('Instance waiter')
+        self.ctx = ctx
+
+    def watch_instance(self, instance, callback=None, timeout=None):
+        # the instance is updated once out of BUILD, before being called back
+        def ready(cloud_instance):
+            if cloud_instance is not None:  # else, timed out
+                instance.cloud_instance = cloud_instance
+                self.ctx.set_instance_runtime_data(instance)
+            if callback:
+                callback(instance)
+
+        return self.watch(instance.cloud_instance.id, ready, timeout)
+
+    def wait_instances(self, instances, timeout=None):
+        waited = self.wait_all([self.watch_instance(instance, timeout=timeout)
+                                for instance in instances], timeout)
+        debug('[{}] {} instances waited on, {} polls so far.', self,
+              len(waited), self.polls)
+        return all(readiness.result is not None for readiness in waited)
+
+    def poll(self, keys, since):
+        return dict((server.id, self.ctx.compact_instance(server))
+                    for server in self.ctx.poll_instances(since)
+                    if server.id in keys and server.status != 'BUILD')
+
+
+class PortWaiter(Waiter):
+    """Waits on the ports of devices, until these have any
+
+    Each tick lists the ports of all pending devices at once, filtered on
+    their device ids, in chunks of MAX_DEVICES per listing. Ports found are
+    written to the port cache of the driver.
+    """
+
+    MAX_DEVICES = 50  # device ids per listing, bounding the url length
+
+    def __init__(self, ctx):
+        super(PortWaiter, self).__init__('Port waiter')
+        self.ctx = ctx
+
+    def wait_ports(self, device_ids, timeout=None):
+        # returns the ports by device id, of the devices which got them
+        return dict((readiness.key, readiness.result)
+                    for readiness in self.wait(device_ids, timeout)
+                    if readiness.result)
+
+    def poll(self, keys, since):
+        keys = sorted(keys)
+        ports = {}
+        for i in range(0, len(keys), self.MAX_DEVICES):
+            for port in self.ctx.poll_ports(keys[i:i + self.MAX_DEVICES]):
+                ports.setdefault(port['device_id'], []).append(port)
+        for device_id, device_ports in ports.items():
+            self.ctx.fill_port_cache(device_id, device_ports)
+        return ports
@@ -193,11 +193,11 @@ class StubDriverContext(DriverContext):
     def kill(self, instance):
         pass
 
-    def new_network(self, cloud, cloud_network):
+    def new_network(self, cloud, cloud_network, cloud_subnets=None):
         return Network(cloud_network.name, cloud_network.cidrs,
                        False, None, cloud, cloud_network, None, self)
 
-    def new_router(self, cloud, cloud_router, net_manager):
+    def new_router(self, cloud, cloud_router, net_manager, networks=None):
         return Router(cloud_router.name, cloud, cloud_router,
                       driver_context=self)
 
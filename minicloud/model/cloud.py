@@ -91,12 +91,17 @@ class Cloud(ContextualStoredEntity):
         info('[{}] authenticate()', self)
         if not self.driver_context:
             if self.type.lower() == 'openstack':
-                from minicloud.clients.os_client import OSClient
+                from minicloud.clients.os_client import HttpSettings, \
+                    OSClient
                 self.set_context(OSDriverContext(
                     OSClient(self.path, self.username,
                              self.tenant, self.password,
                              self.user_domain_id,
-                             self.project_domain_id)))
+                             self.project_domain_id,
+                             HttpSettings(self.get('http_pool_size'),
+                                          self.get('http_connect_timeout'),
+                                          self.get('http_read_timeout'),
+                                          self.get('http_keepalive')))))
             else:
                 self.set_context(StubDriverContext())
 
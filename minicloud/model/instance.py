@@ -4,8 +4,6 @@ from minicloud.core.core_out import debug, error, info
 from minicloud.core.core_types import IntegrityException
 from minicloud.core.core_utils import pop_first
 
-import time
-
 __author__ = 'Kris Sterckx'
 
 
@@ -104,6 +102,12 @@ class Instance(ContextualChildEntity):
     def is_stubbed(self):
         return self.cloud.is_stubbed()
 
+    def clone(self, name):
+        # a same instance, to be booted under another name
+        return Instance(name, self.cluster_name, self.flavor, self.image,
+                        self.sg, self.network, cloud=self.cloud,
+                        driver_context=self.driver_context)
+
     def check_status(self, status='ACTIVE', negative_check=False, deep=False):
         if not negative_check and self.status == status or \
                 negative_check and self.status != status:
@@ -112,12 +116,9 @@ class Instance(ContextualChildEntity):
         return self.reread().check_status(status, negative_check) if deep \
             else False
 
-    def when_active(self):
-        while True:
-            if self.check_status('BUILD', True, True):
-                break
-            else:
-                time.sleep(1)
+    def when_active(self, timeout=None):
+        if not self.check_status('BUILD', True):
+            self.driver_context.wait_active([self], timeout)
         return self.status == 'ACTIVE'
 
     def is_active(self, deep=False):
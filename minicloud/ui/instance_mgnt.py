@@ -1,4 +1,5 @@
-from minicloud.core.core_in import string_input, boolean_input
+from minicloud.core.core_in import string_input, boolean_input, \
+    numerical_input
 from minicloud.core.core_out import error, output
 from minicloud.core.core_types import DoesNotExistException,\
     MiniCloudException
@@ -9,6 +10,8 @@ __author__ = 'Kris Sterckx'
 
 
 class InstanceMgnt(EntityMgnt):
+    MAX_INSTANCES_PER_ADD = 100
+
     def __init__(self, minicloud_mgnt):
         super(InstanceMgnt, self).__init__(
             minicloud_mgnt.manager.instance_manager)
@@ -58,6 +61,8 @@ class InstanceMgnt(EntityMgnt):
     def add_entity(self, retry=False):
         from minicloud.model.instance import Instance
         name = string_input('Name')
+        count = numerical_input('Number of instances', 1,
+                                self.MAX_INSTANCES_PER_ADD)
         if self.minicloud_mgnt.manager.clusters_supported() and \
                 len(self.cluster_manager.list()) > 1 and \
                 boolean_input('\nDo you want to deploy this instance in a '
@@ -136,7 +141,9 @@ class InstanceMgnt(EntityMgnt):
 
         output()
         make_routable = boolean_input(
-            'Do you want this instance to be routable', default=False)
+            'Do you want %s to be routable' % (
+                'these instances' if count > 1 else 'this instance'),
+            default=False)
 
         if make_routable:
             external_network = self.obtain_external_network(network)
@@ -147,14 +154,21 @@ class InstanceMgnt(EntityMgnt):
             name, cluster.name if cluster else None,
             flavor, image, sg, network, cloud=cloud)
 
-        self.manager.add(instance)
+        if count > 1:
+            instances = self.manager.add_many(instance, count)
+        else:
+            instances = [self.manager.add(instance)]
 
         if make_routable:
-            fip = self.make_instance_routable(instance, external_network)
-            if fip:
-                output('Instance is routable via {}.', fip)
+            if count > 1:
+                output('Waiting for instances to be active...')
+                self.manager.wait_ports(self.manager.wait_active(instances))
+            for instance in instances:
+                fip = self.make_instance_routable(instance, external_network)
+                if fip:
+                    output('{} is routable via {}.', instance.name, fip)
 
-        return instance
+        return instances[0]
 
     @staticmethod
     def force_deep_topology():
@@ -166,7 +180,7 @@ class InstanceMgnt(EntityMgnt):
     def topology(self, level, instance, deep_topology,
                  root_indent, root_prefix, prefix,
                  show_empty_entities=False, optimize_list=False):
-        instance.get_fip(deep=True)
+        instance.get_fip(deep=instance.fip is None)  # else, known already
         return root_indent + root_prefix + instance.repr() + '\n', 1, True
 
     def make_routable(self):
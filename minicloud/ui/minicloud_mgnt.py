@@ -61,7 +61,8 @@ class MiniCloudMgnt(EntityMgnt):
                 ROUTER_MGNT = 4
                 NETWORK_MGNT = 5
                 INSTANCE_MGNT = 6
-                DESTROY_ALL = 7
+                CACHE_STATISTICS = 7
+                DESTROY_ALL = 8
 
                 options_list = ['Cloud topology',
                                 'Cloud management',
@@ -69,6 +70,7 @@ class MiniCloudMgnt(EntityMgnt):
                                 'Router management',
                                 'Network management',
                                 'Instance management',
+                                'Cache statistics',
                                 'Clear/Wipe cloud',
                                 'Exit (keep data)']
             return Choices()
@@ -82,13 +84,15 @@ class MiniCloudMgnt(EntityMgnt):
                 ROUTER_MGNT = 3
                 NETWORK_MGNT = 4
                 INSTANCE_MGNT = 5
-                DESTROY_ALL = 6
+                CACHE_STATISTICS = 6
+                DESTROY_ALL = 7
 
                 options_list = ['Cloud topology',
                                 'Cloud management',
                                 'Router management',
                                 'Network management',
                                 'Instance management',
+                                'Cache statistics',
                                 'Clear/Wipe cloud',
                                 'Exit (keep data)']
             return Choices()
@@ -111,6 +115,8 @@ class MiniCloudMgnt(EntityMgnt):
                 self.network_mgnt.manage_entities()
             elif choice == choices.INSTANCE_MGNT:
                 self.instance_mgnt.manage_entities()
+            elif choice == choices.CACHE_STATISTICS:
+                self.show_stats()
             elif choice == choices.DESTROY_ALL:
                 self.clear()
             else:
@@ -135,7 +141,8 @@ class MiniCloudMgnt(EntityMgnt):
                 'MINICLOUD_DB_PASSWORD', 'MINICLOUD_DB_NAME')
 
         try:
-            mc = MiniCloud(database, cluster_support)
+            mc = MiniCloud(database, cluster_support,
+                           use_snapshot=self.in_batch_mode())
 
             if self.love_gimmicks:
                 import datetime
@@ -218,6 +225,8 @@ class MiniCloudMgnt(EntityMgnt):
                        show_empty_network_entities=True,
                        use_cached_list_for_entities=False):
         _('Building topology...', thru_silent_mode=True)
+        if self.manager.snapshot_topology(deep_topology):
+            deep_topology = False  # all is fetched fresh now
 
         trace('[{}] --- build_topology ({}) ---', self,
               entity.name if entity else '')
@@ -270,6 +279,45 @@ class MiniCloudMgnt(EntityMgnt):
         else:
             echo('There is no cloud. Abort.')
 
+    def show_stats(self):
+        line = '{:<16}{:>8}{:>8}{:>7}{:>9}{:>7}{:>9}{:>11}{:>10}'
+        echo()
+        echo(line.format('Cache', 'hits', 'misses', 'deep', 'shallow',
+                         'delta', 'fetched', 'list time', 'neg.hits'))
+        for manager, stats in self.manager.cache_statistics():
+            echo(line.format(
+                manager.entities_title(), stats['hits'], stats['misses'],
+                stats['deep_syncs'], stats['shallow_syncs'],
+                stats['delta_syncs'], stats['fetched'],
+                '{:.2f}s'.format(stats['list_time']),
+                stats['negative']['hits']))
+
+        for cloud, driver_stats in self.manager.driver_cache_statistics():
+            for cache, stats in sorted(driver_stats.items()):
+                echo('{} {} cache: {} of max {} entries, ~{} bytes, {} hits, '
+                     '{} misses, {} evictions'.format(
+                         cloud.name, cache, stats['size'], stats['max_size'],
+                         stats['bytes'], stats['hits'], stats['misses'],
+                         stats['evictions']))
+
+        for cloud, stats in self.manager.http_statistics():
+            if stats:
+                echo('{} http: {} requests over {} connections in {} pools '
+                     '(size {}), {} in flight (peak {})'.format(
+                         cloud.name, stats['requests'], stats['connections'],
+                         stats['pools'], stats['pool_size'],
+                         stats['in_flight'], stats['peak_in_flight']))
+
+        for cloud, waiter_stats in self.manager.readiness_statistics():
+            for waiter, stats in sorted(waiter_stats.items()):
+                if stats['resolved'] or stats['expired']:
+                    echo('{} {} waiter: {} ready (mean {:.1f}s, max {:.1f}s), '
+                         '{} timed out, {} pending, {} polls'.format(
+                             cloud.name, waiter, stats['resolved'],
+                             stats['mean_ready_time'] or 0,
+                             stats['max_ready_time'], stats['expired'],
+                             stats['pending'], stats['polls']))
+
     def clear(self, cloud=None):
         if cloud:
             raise NotImplementedError  # can't clear one particular cloud